@@ -1,12 +1,24 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, flash, Response
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, flash, Response, has_request_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape as escape_xml
 from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 import os
 import json
+import base64
 import uuid
 import time
 import re
-from datetime import datetime, timedelta
+import threading
+import hmac
+import hashlib
+import gzip
+import mimetypes
+from collections import OrderedDict
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
@@ -16,15 +28,74 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
 from flask_caching import Cache
+from jinja2 import FileSystemLoader, FileSystemBytecodeCache
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Carrega variáveis de ambiente
 load_dotenv()
 
 app = Flask(__name__)
-app.config['CACHE_TYPE'] = 'SimpleCache'
+# Cache compartilhado entre os workers do gunicorn em um arquivo SQLite local (cache_sqlite.py)
+# CACHE_TYPE=SimpleCache volta ao cache por processo
+app.config['CACHE_TYPE'] = os.getenv("CACHE_TYPE", 'cache_sqlite.SQLiteCache')
 app.config['CACHE_DEFAULT_TIMEOUT'] = 300
+app.config['CACHE_SQLITE_PATH'] = os.getenv("CACHE_SQLITE_PATH", "/tmp/leanttro_cache.sqlite3")
+app.config['CACHE_SQLITE_MAX_BYTES'] = int(os.getenv("CACHE_SQLITE_MAX_MB", 256)) * 1024 * 1024
 cache = Cache(app)
 
+# TEMPLATES
+# Bytecode dos templates fica em disco (compartilhado entre workers e entre reinícios) e o HTML
+# é compilado já sem a indentação e os espaços no fim das linhas. Espaços no meio da linha ficam
+# (strings do Jinja e atributos), e <pre>, <textarea>, <script> e blocos {% raw %} saem intactos.
+# As quebras de linha ficam: erros do Jinja continuam apontando a linha certa do arquivo fonte.
+# Todos os templates são compilados na importação, antes do worker receber tráfego.
+TEMPLATES_CACHE_DIR = os.getenv("TEMPLATES_CACHE_DIR", "/tmp/leanttro_jinja")
+TEMPLATES_MINIFICAR = os.getenv("TEMPLATES_MINIFICAR", "1") == "1"
+TEMPLATES_AQUECER = os.getenv("TEMPLATES_AQUECER", "1") == "1"
+_TRECHOS_PRESERVADOS = re.compile(
+    r'(<pre\b.*?</pre>|<textarea\b.*?</textarea>|<script\b.*?</script>'
+    r'|\{%-?\s*raw\s*-?%\}.*?\{%-?\s*endraw\s*-?%\})', re.S | re.I)
+
+def minificar_html(fonte):
+    partes = _TRECHOS_PRESERVADOS.split(fonte)
+    for i in range(0, len(partes), 2):
+        linhas = partes[i].split('\n')
+        if len(linhas) < 3: continue
+        # Primeira e última linha encostam em trechos preservados, só o meio perde indentação
+        meio = [l.strip() for l in linhas[1:-1]]
+        partes[i] = '\n'.join([linhas[0]] + meio + [linhas[-1].lstrip()])
+    return ''.join(partes)
+
+class LoaderMinificado(FileSystemLoader):
+    def get_source(self, environment, template):
+        fonte, arquivo, atualizado = super().get_source(environment, template)
+        return minificar_html(fonte), arquivo, atualizado
+
+os.makedirs(TEMPLATES_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATES_CACHE_DIR)
+if TEMPLATES_MINIFICAR:
+    app.jinja_loader = LoaderMinificado(os.path.join(app.root_path, app.template_folder))
+
+def precompilar_templates():
+    # Compila todos os templates no ambiente do app (e grava o bytecode em disco)
+    compilados, erros = 0, []
+    for nome in app.jinja_env.list_templates():
+        try:
+            app.jinja_env.get_template(nome)
+            compilados += 1
+        except Exception as e:
+            erros.append((nome, e))
+            print(f"Erro ao compilar template {nome}: {e}")
+    return compilados, erros
+
+@app.cli.command('precompilar-templates')
+def precompilar_templates_cmd():
+    compilados, erros = precompilar_templates()
+    print(f"{compilados} templates compilados em {TEMPLATES_CACHE_DIR}, {len(erros)} com erro")
+
 # Configuração para extrair o IP real por trás de proxies/load balancers
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
@@ -118,6 +189,334 @@ def get_upload_headers():
     # Para upload não se usa Content-Type json
     return {"Authorization": f"Bearer {DIRECTUS_TOKEN}"}
 
+# CLIENTE DIRECTUS COMPARTILHADO
+# Uma sessão por worker com pool de conexões keep-alive para o DIRECTUS_URL.
+# Leituras (GET/HEAD) são repetidas com backoff em falhas de conexão e 502/503/504, dentro de um prazo total.
+# Timeout de leitura não é repetido: uma leitura lenta já gastou o tempo que a requisição tinha.
+# Escritas nunca são repetidas automaticamente.
+DIRECTUS_POOL_CONEXOES = int(os.getenv("DIRECTUS_POOL_CONEXOES", 4)) # pools por host
+DIRECTUS_POOL_MAXIMO = int(os.getenv("DIRECTUS_POOL_MAXIMO", 20)) # conexões mantidas por host (gunicorn usa 10 threads)
+DIRECTUS_TENTATIVAS = int(os.getenv("DIRECTUS_TENTATIVAS", 2)) # novas tentativas em leituras
+DIRECTUS_BACKOFF = float(os.getenv("DIRECTUS_BACKOFF", 0.3)) # segundos, dobra a cada tentativa
+DIRECTUS_TIMEOUT_CONEXAO = float(os.getenv("DIRECTUS_TIMEOUT_CONEXAO", 3)) # segundos para abrir a conexão
+DIRECTUS_PRAZO_LEITURA = float(os.getenv("DIRECTUS_PRAZO_LEITURA", 10)) # segundos somando todas as tentativas
+STATUS_REPETIVEIS = (502, 503, 504)
+
+class DirectusClient:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._sessao_atual = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._contadores = {}
+
+    def _sessao(self):
+        # Sessões não podem ser herdadas pelo fork do gunicorn Cada worker cria a sua
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    adapter = HTTPAdapter(pool_connections=DIRECTUS_POOL_CONEXOES, pool_maxsize=DIRECTUS_POOL_MAXIMO, max_retries=0)
+                    sessao = requests.Session()
+                    sessao.mount('http://', adapter)
+                    sessao.mount('https://', adapter)
+                    self._sessao_atual = sessao
+                    self._contadores = {}
+                    self._pid = os.getpid()
+        return self._sessao_atual
+
+    def _colecao(self, url):
+        # /items/produtos/123 -> produtos | /files -> files | /graphql -> graphql
+        partes = urlsplit(url).path.strip('/').split('/')
+        if partes and partes[0] == 'items' and len(partes) > 1:
+            return partes[1]
+        return partes[0] if partes else ''
+
+    def _contar(self, colecao, metodo, inicio, erro):
+        chave = f"{colecao}:{metodo}"
+        with self._lock:
+            c = self._contadores.setdefault(chave, {"requisicoes": 0, "erros": 0, "tempo_ms": 0.0})
+            c["requisicoes"] += 1
+            c["tempo_ms"] += (time.time() - inicio) * 1000
+            if erro: c["erros"] += 1
+
+    def request(self, metodo, url, **kwargs):
+        if url.startswith('/'):
+            url = f"{self.base_url}{url}"
+        # Upload multipart não pode levar Content-Type json
+        kwargs.setdefault('headers', get_upload_headers() if 'files' in kwargs else get_headers())
+        timeout = kwargs.pop('timeout', 7)
+        inicio = time.time()
+        erro = True
+        try:
+            if metodo not in ('GET', 'HEAD'):
+                resp = self._sessao().request(metodo, url, timeout=timeout, **kwargs)
+            else:
+                resp = self._ler(metodo, url, timeout, inicio + max(timeout, DIRECTUS_PRAZO_LEITURA), kwargs)
+            erro = resp.status_code >= 400
+            return resp
+        finally:
+            self._contar(self._colecao(url), metodo, inicio, erro)
+
+    def _ler(self, metodo, url, timeout, prazo, kwargs):
+        tentativa = 0
+        while True:
+            restante = max(prazo - time.time(), 0.1)
+            try:
+                resp = self._sessao().request(metodo, url, timeout=(min(DIRECTUS_TIMEOUT_CONEXAO, restante), min(timeout, restante)), **kwargs)
+            except requests.ConnectionError:
+                # Falha de conexão (inclui ConnectTimeout) ReadTimeout não cai aqui e não é repetido
+                if not self._esperar_nova_tentativa(tentativa, prazo): raise
+            else:
+                if resp.status_code not in STATUS_REPETIVEIS or not self._esperar_nova_tentativa(tentativa, prazo):
+                    return resp
+                resp.close()
+            tentativa += 1
+
+    def _esperar_nova_tentativa(self, tentativa, prazo):
+        espera = DIRECTUS_BACKOFF * (2 ** tentativa)
+        # Só tenta de novo se ainda sobra prazo para a conexão depois do backoff
+        if tentativa >= DIRECTUS_TENTATIVAS or time.time() + espera + DIRECTUS_TIMEOUT_CONEXAO > prazo:
+            return False
+        time.sleep(espera)
+        return True
+
+    def get(self, url, **kwargs): return self.request('GET', url, **kwargs)
+    def post(self, url, **kwargs): return self.request('POST', url, **kwargs)
+    def patch(self, url, **kwargs): return self.request('PATCH', url, **kwargs)
+    def delete(self, url, **kwargs): return self.request('DELETE', url, **kwargs)
+
+    def status(self):
+        with self._lock:
+            contadores = {k: {**v, "tempo_ms": round(v["tempo_ms"], 1)} for k, v in self._contadores.items()}
+        return {
+            "pid": os.getpid(),
+            "pool_conexoes": DIRECTUS_POOL_CONEXOES,
+            "pool_maximo": DIRECTUS_POOL_MAXIMO,
+            "tentativas_leitura": DIRECTUS_TENTATIVAS,
+            "prazo_leitura": DIRECTUS_PRAZO_LEITURA,
+            "contadores": contadores
+        }
+
+directus = DirectusClient(DIRECTUS_URL)
+
+# CARGA EM LOTE DE COLEÇÕES
+# Várias consultas do Directus resolvidas em uma única requisição GraphQL.
+# Os campos de cada coleção vêm da introspecção do schema (equivalente a fields=* com relações só pelo id).
+# Se o GraphQL falhar, cai para as mesmas consultas via REST em um executor compartilhado do worker.
+GRAPHQL_PAUSA_APOS_ERRO = int(os.getenv("GRAPHQL_PAUSA_APOS_ERRO", 300)) # segundos usando REST após falha do GraphQL
+
+# PERFIS DE CAMPOS
+# Cada tela pede ao Directus só os campos que o template dela usa, em vez de fields=*.*
+# (que expande todas as relações). Menos payload, menos JSON para decodificar e menos memória em cache.
+# Card da vitrine: o que os cards, a busca e os filtros usam, mais os poucos campos que só as páginas
+# de produto/case leem, para a mesma busca aquecer o cache dessas páginas
+CAMPOS_PRODUTO_CARD = [
+    "id", "nome", "slug", "preco", "sort", "categoria_id", "descricao", "variantes", "origem",
+    "status_urgencia", "classe_frete", "estoque", "consulte", "a_partir_de", "layout_case",
+    "link_projeto", "whatsapp_projeto", "imagem_destaque", "imagem1", "imagem2", "imagem3",
+    "imagem4", "imagem5", "imagem_secundaria", "date_updated", "date_created",
+    "resumo", "tags", "meta_descricao", "ficha_tecnica", "diretor", "dop", "depoimento"
+]
+# Produto inteiro, expandindo só o nome da categoria (páginas de produto)
+CAMPOS_PRODUTO_DETALHE = ["*", "categoria_id.id", "categoria_id.nome"]
+CAMPOS_PRODUTO_ADMIN = [
+    "id", "nome", "preco", "estoque", "sort", "categoria_id", "descricao", "variantes", "consulte",
+    "a_partir_de", "layout_case", "link_projeto", "whatsapp_projeto", "imagem_destaque"
+]
+CAMPOS_SITEMAP = ["slug", "date_updated", "date_created"]
+CAMPOS_POST_DETALHE = ["id", "titulo", "slug", "resumo", "conteudo", "capa", "date_created", "categoria_id.id", "categoria_id.nome"]
+CAMPOS_POST_ADMIN = ["id", "titulo", "resumo", "conteudo", "date_created"]
+
+@dataclass
+class Consulta:
+    colecao: str
+    filtro: dict
+    sort: list = None
+    limit: int = None
+    campos: list = None # None = todos os campos da coleção
+
+@dataclass
+class DadosVitrine:
+    categorias: list = field(default_factory=list)
+    produtos: list = field(default_factory=list)
+    posts: list = field(default_factory=list)
+    agenda: list = field(default_factory=list)
+
+@dataclass
+class DadosPainel:
+    categorias: list = field(default_factory=list)
+    produtos: list = field(default_factory=list)
+    posts: list = field(default_factory=list)
+    inscritos: list = field(default_factory=list)
+    agenda: list = field(default_factory=list)
+
+_executor_directus = ThreadPoolExecutor(max_workers=8, thread_name_prefix="directus")
+_esquema_graphql = {}
+_graphql_pausado_ate = 0.0
+
+def _gql_valor(valor):
+    # Serializa filtros/listas Python como literal GraphQL (chaves sem aspas)
+    if isinstance(valor, dict):
+        return "{" + ", ".join(f"{k}: {_gql_valor(v)}" for k, v in valor.items()) + "}"
+    if isinstance(valor, (list, tuple)):
+        return "[" + ", ".join(_gql_valor(v) for v in valor) + "]"
+    if isinstance(valor, bool):
+        return "true" if valor else "false"
+    if valor is None:
+        return "null"
+    if isinstance(valor, (int, float)):
+        return str(valor)
+    return json.dumps(str(valor), ensure_ascii=False)
+
+def _carregar_esquema(colecoes):
+    # Introspecção dos tipos GraphQL, guardada por processo {colecao: {campo: eh_relacao}}
+    faltando = [c for c in colecoes if c not in _esquema_graphql]
+    if not faltando:
+        return
+    query = "{ " + " ".join(f'{c}: __type(name: "{c}") {{ fields {{ name type {{ kind ofType {{ kind }} }} }} }}' for c in faltando) + " }"
+    resp = directus.post("/graphql", json={"query": query}, timeout=7)
+    dados = resp.json() if resp.status_code == 200 else {}
+    if dados.get('errors') or not dados.get('data'):
+        raise RuntimeError(f"Introspecção GraphQL falhou: {resp.status_code}")
+    for c in faltando:
+        tipo = dados['data'].get(c)
+        if not tipo:
+            raise RuntimeError(f"Coleção {c} ausente no schema GraphQL")
+        campos = {}
+        for f in tipo['fields']:
+            kind = f['type']['kind']
+            if kind == 'NON_NULL': kind = (f['type'].get('ofType') or {}).get('kind')
+            # Relações O2M/M2M (LIST) e funções *_func não entram no equivalente a fields=*
+            if kind == 'LIST' or f['name'].endswith('_func'):
+                continue
+            campos[f['name']] = kind == 'OBJECT'
+        _esquema_graphql[c] = campos
+
+def _gql_filtro(colecao, filtro):
+    # No GraphQL o filtro de uma relação M2O é aplicado no id do item relacionado
+    esquema = _esquema_graphql[colecao]
+    return {k: ({"id": v} if esquema.get(k) and not k.startswith('_') else v) for k, v in filtro.items()}
+
+def _gql_arvore(consulta):
+    # Campos pedidos como árvore {campo: subcampos ou None}, igual ao fields do REST:
+    # "*" são todos os campos da coleção e "categoria_id.nome" expande a relação
+    esquema = _esquema_graphql[consulta.colecao]
+    arvore = {}
+    for caminho in consulta.campos or ["*"]:
+        nome, _, resto = caminho.partition('.')
+        if nome == "*":
+            for n in esquema: arvore.setdefault(n, None)
+        elif nome in esquema and resto and esquema[nome]:
+            no = arvore[nome] = arvore.get(nome) or {}
+            *meio, ultimo = resto.split('.')
+            for parte in meio:
+                if not no.get(parte): no[parte] = {}
+                no = no[parte]
+            no.setdefault(ultimo, None)
+        elif nome in esquema:
+            arvore.setdefault(nome, None)
+    return arvore
+
+def _gql_subselecao(arvore):
+    return " ".join(f"{n} {{ {_gql_subselecao(sub)} }}" if sub else n for n, sub in arvore.items())
+
+def _gql_selecao(consulta):
+    # Retorna a seleção e as relações pedidas sem subcampos, que voltam só com o id (como no REST)
+    esquema = _esquema_graphql[consulta.colecao]
+    arvore = _gql_arvore(consulta)
+    achatar = {n for n, sub in arvore.items() if sub is None and esquema.get(n)}
+    selecao = " ".join(
+        f"{n} {{ id }}" if n in achatar else (f"{n} {{ {_gql_subselecao(sub)} }}" if sub else n)
+        for n, sub in arvore.items()
+    )
+    return selecao, achatar
+
+def _achatar_relacoes(item, achatar):
+    # Deixa o resultado do GraphQL no mesmo formato do REST: relação sem subcampos vira só o id
+    for k in achatar:
+        v = item.get(k)
+        if isinstance(v, dict):
+            item[k] = v.get('id')
+    return item
+
+def _buscar_graphql(consultas):
+    _carregar_esquema({c.colecao for c in consultas.values()})
+    partes = []
+    achatar = {}
+    for alias, c in consultas.items():
+        args = [f"filter: {_gql_valor(_gql_filtro(c.colecao, c.filtro))}"]
+        if c.sort: args.append(f"sort: {_gql_valor(c.sort)}")
+        if c.limit is not None: args.append(f"limit: {c.limit}")
+        selecao, achatar[alias] = _gql_selecao(c)
+        partes.append(f"{alias}: {c.colecao}({', '.join(args)}) {{ {selecao} }}")
+    resp = directus.post("/graphql", json={"query": "{ " + " ".join(partes) + " }"}, timeout=10)
+    dados = resp.json() if resp.status_code == 200 else {}
+    if dados.get('errors') or not dados.get('data'):
+        raise RuntimeError(f"Consulta GraphQL falhou: {resp.status_code} {dados.get('errors')}")
+    return {alias: [_achatar_relacoes(i, achatar[alias]) for i in (dados['data'].get(alias) or [])] for alias in consultas}
+
+def _get_rest(consulta, extras=None):
+    params = {"filter": json.dumps(consulta.filtro), "fields": ",".join(consulta.campos) if consulta.campos else "*"}
+    if consulta.sort: params["sort"] = ",".join(consulta.sort)
+    if consulta.limit is not None: params["limit"] = consulta.limit
+    if extras: params.update(extras)
+    r = directus.get(f"/items/{consulta.colecao}", params=params, timeout=7)
+    if r.status_code in (400, 403) and consulta.campos:
+        # Campo do perfil inexistente nesta instalação: repete com todos os campos
+        print(f"Perfil de campos recusado em {consulta.colecao} ({r.status_code}), usando fields=*")
+        params["fields"] = "*"
+        r = directus.get(f"/items/{consulta.colecao}", params=params, timeout=7)
+    if r.status_code != 200:
+        raise RuntimeError(f"Directus respondeu {r.status_code} para {consulta.colecao}")
+    return r.json()
+
+def _buscar_rest(consulta):
+    return _get_rest(consulta)['data']
+
+def buscar_pagina(consulta, pagina):
+    # Uma página da consulta (consulta.limit itens) e o total de itens que casam com o filtro
+    dados = _get_rest(consulta, {"page": pagina, "meta": "filter_count"})
+    total = (dados.get('meta') or {}).get('filter_count')
+    return dados['data'], int(total) if total is not None else len(dados['data'])
+
+def buscar_colecoes(consultas):
+    # consultas: {alias: Consulta} -> {alias: [itens]}
+    global _graphql_pausado_ate
+    if time.time() >= _graphql_pausado_ate:
+        try:
+            return _buscar_graphql(consultas)
+        except Exception as e:
+            _graphql_pausado_ate = time.time() + GRAPHQL_PAUSA_APOS_ERRO
+            _esquema_graphql.clear()
+            print(f"GraphQL indisponível, usando REST: {e}")
+    # Falha em qualquer coleção levanta exceção para quem chamou não cachear dados incompletos
+    futuros = {alias: _executor_directus.submit(_buscar_rest, c) for alias, c in consultas.items()}
+    return {alias: f.result() for alias, f in futuros.items()}
+
+def buscar_dados_vitrine(loja_id):
+    # Tudo que a vitrine de uma loja precisa em uma ida ao Directus
+    publicado = {"loja_id": {"_eq": loja_id}, "status": {"_eq": "published"}}
+    dados = buscar_colecoes({
+        "categorias": Consulta("categorias", publicado, sort=["sort"]),
+        "produtos": Consulta("produtos", publicado, campos=CAMPOS_PRODUTO_CARD),
+        # Posts com conteúdo: são poucos e aquecem o cache das páginas do blog
+        "posts": Consulta("posts", publicado, sort=["-date_created"], limit=6, campos=CAMPOS_POST_DETALHE),
+        "agenda": Consulta("agenda", {"loja_id": {"_eq": loja_id}}, sort=["data_hora"]),
+    })
+    return DadosVitrine(**dados)
+
+def buscar_dados_painel(loja_id):
+    # Dados do painel admin (inclui itens não publicados e os leads)
+    da_loja = {"loja_id": {"_eq": loja_id}}
+    dados = buscar_colecoes({
+        "categorias": Consulta("categorias", da_loja, sort=["sort"]),
+        "produtos": Consulta("produtos", da_loja, limit=100, campos=CAMPOS_PRODUTO_ADMIN),
+        "posts": Consulta("posts", da_loja, sort=["-date_created"], limit=20, campos=CAMPOS_POST_ADMIN),
+        "inscritos": Consulta("clientes_loja", da_loja, sort=["-date_created"]),
+        "agenda": Consulta("agenda", da_loja, sort=["data_hora"]),
+    })
+    return DadosPainel(**dados)
+
 def get_img_url(image_id_or_obj):
     # Trata URLs de imagens vindas do Directus ID Objeto ou URL completa com compressão webp
     if not image_id_or_obj: return ""
@@ -125,15 +524,61 @@ def get_img_url(image_id_or_obj):
     if isinstance(image_id_or_obj, str) and image_id_or_obj.startswith('http'): return image_id_or_obj
     return f"{DIRECTUS_URL}/assets/{image_id_or_obj}?quality=80&format=webp"
 
+# UPLOADS PARA O DIRECTUS
+# O corpo multipart é gerado em pedaços direto do arquivo que o Werkzeug já guardou (memória ou disco),
+# em vez do files= do requests, que monta o corpo inteiro em memória antes de enviar.
+# Como o corpo informa o tamanho (__len__), o requests manda Content-Length em vez de chunked.
+# Os campos de imagem de um mesmo formulário sobem em paralelo no executor de uploads.
+UPLOAD_TIMEOUT = int(os.getenv("UPLOAD_TIMEOUT", 15))
+UPLOADS_PARALELOS = int(os.getenv("UPLOADS_PARALELOS", 6)) # uploads simultâneos por worker
+UPLOAD_BLOCO = 64 * 1024
+
+_executor_uploads = ThreadPoolExecutor(max_workers=UPLOADS_PARALELOS, thread_name_prefix="uploads")
+
+class CorpoMultipart:
+    def __init__(self, file_storage, campo='file'):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        nome = secure_filename(file_storage.filename) or 'arquivo'
+        tipo = file_storage.mimetype or mimetypes.guess_type(nome)[0] or 'application/octet-stream'
+        self._inicio = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{campo}"; filename="{nome}"\r\n'
+            f'Content-Type: {tipo}\r\n\r\n'
+        ).encode('utf-8')
+        self._fim = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self._arquivo = file_storage.stream
+        try:
+            self._arquivo.seek(0, os.SEEK_END)
+            self._tamanho = self._arquivo.tell()
+            self._arquivo.seek(0)
+        except (AttributeError, OSError):
+            # Stream sem seek: único caso em que o arquivo é lido inteiro para memória
+            conteudo = file_storage.read()
+            self._arquivo = None
+            self._inicio += conteudo
+            self._tamanho = len(conteudo)
+
+    def __len__(self):
+        return len(self._inicio) + self._tamanho + len(self._fim)
+
+    def __iter__(self):
+        yield self._inicio
+        if self._arquivo is not None:
+            self._arquivo.seek(0)
+            while True:
+                bloco = self._arquivo.read(UPLOAD_BLOCO)
+                if not bloco: break
+                yield bloco
+        yield self._fim
+
 def upload_file_to_directus(file_storage):
     # Faz upload de arquivo para o Directus e retorna o ID
     try:
-        url = f"{DIRECTUS_URL}/files"
-        filename = secure_filename(file_storage.filename)
-        files = {'file': (filename, file_storage, file_storage.mimetype)}
-        
-        response = requests.post(url, headers=get_upload_headers(), files=files, timeout=15)
-        
+        corpo = CorpoMultipart(file_storage)
+        headers = {**get_upload_headers(), "Content-Type": corpo.content_type}
+        response = directus.post(f"{DIRECTUS_URL}/files", data=corpo, headers=headers, timeout=UPLOAD_TIMEOUT)
+
         if response.status_code in [200, 201]:
             return response.json()['data']['id']
         else:
@@ -142,6 +587,26 @@ def upload_file_to_directus(file_storage):
         print(f"Exceção no upload: {e}")
     return None
 
+def enviar_arquivos(campos):
+    # Sobe em paralelo os arquivos enviados nos campos do formulário
+    # Retorna ({campo: id do arquivo}, [nomes dos arquivos que falharam])
+    arquivos = {c: request.files.get(c) for c in campos}
+    arquivos = {c: f for c, f in arquivos.items() if f and f.filename}
+    futuros = {c: _executor_uploads.submit(upload_file_to_directus, f) for c, f in arquivos.items()}
+    enviados, falhas = {}, []
+    for campo, futuro in futuros.items():
+        fid = futuro.result()
+        if fid: enviados[campo] = fid
+        else: falhas.append(arquivos[campo].filename)
+    return enviados, falhas
+
+def avisar_uploads(enviados, falhas):
+    # Resultado por arquivo no flash do painel
+    if enviados:
+        flash(f"{len(enviados)} imagem(ns) enviada(s).", 'success')
+    for nome in falhas:
+        flash(f"Falha ao enviar a imagem {nome}.", 'error')
+
 def gerar_slug(texto):
     if not texto: return ""
     import unicodedata
@@ -178,6 +643,426 @@ def send_reset_email(user_email, reset_url, nome_loja):
         print(f"Erro ao enviar e-mail de recuperação: {e}")
         return False
 
+# COALESCÊNCIA DE RECONSTRUÇÕES (SINGLE-FLIGHT)
+# Quando uma chave expira, só um thread por worker reconstrói e os demais aguardam o resultado.
+# Um lock no cache compartilhado coordena também os outros workers (COALESCER_ENTRE_WORKERS=0 desliga).
+COALESCER_ENTRE_WORKERS = os.getenv("COALESCER_ENTRE_WORKERS", "1") == "1"
+COALESCER_ESPERA = float(os.getenv("COALESCER_ESPERA", 10)) # segundos aguardando a reconstrução de outro
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._em_andamento = {}
+
+    def executar(self, chave, funcao):
+        with self._lock:
+            chamada = self._em_andamento.get(chave)
+            lider = chamada is None
+            if lider:
+                chamada = {"evento": threading.Event(), "resultado": None, "erro": None}
+                self._em_andamento[chave] = chamada
+
+        if not lider:
+            if not chamada["evento"].wait(COALESCER_ESPERA):
+                raise TimeoutError(f"Reconstrução de {chave} demorou mais de {COALESCER_ESPERA}s")
+            if chamada["erro"]:
+                raise chamada["erro"]
+            return chamada["resultado"]
+
+        try:
+            chamada["resultado"] = funcao()
+            return chamada["resultado"]
+        except Exception as e:
+            chamada["erro"] = e
+            raise
+        finally:
+            with self._lock:
+                self._em_andamento.pop(chave, None)
+            chamada["evento"].set()
+
+    def em_andamento(self, chave):
+        return chave in self._em_andamento
+
+coalescedor = SingleFlight()
+
+# CACHE STALE-WHILE-REVALIDATE
+# Cada entrada guarda o valor e o horário em que foi montada, com validade máxima (ttl_maximo).
+# Até ttl_fresco o valor é servido direto. Depois disso continua sendo servido enquanto um
+# thread em segundo plano reconstrói. Se o Directus falhar, a versão antiga permanece.
+# Só um miss completo (nada no cache) espera a reconstrução.
+_executor_revalidacao = ThreadPoolExecutor(max_workers=4, thread_name_prefix="revalidacao")
+
+def _reconstruir_swr(chave, construir, ttl_maximo):
+    trava = f"reconstruindo_{chave}"
+    travou = COALESCER_ENTRE_WORKERS and cache.add(trava, os.getpid(), timeout=int(COALESCER_ESPERA) + 1)
+    if COALESCER_ENTRE_WORKERS and not travou:
+        # Outro worker já está reconstruindo Aguarda ele gravar antes de tentar por conta própria
+        anterior = cache.get(chave)
+        limite = time.time() + COALESCER_ESPERA
+        while time.time() < limite:
+            time.sleep(0.05)
+            # Lock lido antes do valor: o líder grava e só depois libera
+            liberada = cache.get(trava) is None
+            envelope = cache.get(chave)
+            if envelope is not None and (anterior is None or envelope["criado"] > anterior["criado"]):
+                return envelope
+            if liberada:
+                # Líder terminou sem gravar (falhou ou não encontrou nada): não espera o prazo inteiro
+                break
+
+    try:
+        valor = construir()
+        envelope = {"valor": valor, "criado": time.time()}
+        # None significa "não existe" e não é guardado
+        if valor is not None:
+            cache.set(chave, envelope, timeout=ttl_maximo)
+        return envelope
+    finally:
+        if travou:
+            cache.delete(trava)
+
+def _revalidar_em_segundo_plano(chave, construir, ttl_maximo):
+    if coalescedor.em_andamento(chave):
+        return
+
+    def tarefa():
+        try:
+            coalescedor.executar(chave, lambda: _reconstruir_swr(chave, construir, ttl_maximo))
+        except Exception as e:
+            print(f"Revalidação de {chave} falhou, mantendo versão anterior: {e}")
+
+    _executor_revalidacao.submit(tarefa)
+
+def cache_swr(chave, construir, ttl_fresco, ttl_maximo):
+    # construir() não pode depender do contexto da requisição e deve levantar exceção quando o Directus falhar
+    envelope = cache.get(chave)
+    if envelope is not None:
+        if time.time() - envelope["criado"] >= ttl_fresco:
+            _revalidar_em_segundo_plano(chave, construir, ttl_maximo)
+        return envelope["valor"]
+
+    def reconstruir():
+        # Outro thread pode ter gravado enquanto este esperava
+        envelope = cache.get(chave)
+        if envelope is not None:
+            return envelope
+        return _reconstruir_swr(chave, construir, ttl_maximo)
+
+    return coalescedor.executar(chave, reconstruir)["valor"]
+
+# VERSÕES POR LOJA E COLEÇÃO (INVALIDAÇÃO POR TAG)
+# Cada loja tem um número de versão por coleção guardado no cache compartilhado.
+# As chaves de cache de uma loja incluem as versões das coleções de que dependem, então
+# invalidar é só incrementar a versão: as entradas antigas deixam de ser lidas e expiram sozinhas,
+# sem afetar as outras lojas. As versões são timestamps em milissegundos (sempre crescentes).
+COLECOES_LOJA = ('lojas', 'categorias', 'produtos', 'posts', 'agenda')
+COLECOES_VITRINE = ('categorias', 'produtos', 'posts', 'agenda')
+
+def versao_loja(loja_id, colecoes=COLECOES_LOJA):
+    chaves = [f"versao_{loja_id}_{c}" for c in colecoes]
+    return "-".join(str(v or 0) for v in cache.get_many(*chaves))
+
+def _incrementar_versao(chave):
+    nova = max(int(time.time() * 1000), (cache.get(chave) or 0) + 1)
+    cache.set(chave, nova, timeout=0)
+    return nova
+
+# PURGE NO CACHE DE BORDA (CDN / proxy reverso)
+# As páginas saem com Surrogate-Key (loja-<id>, loja-<id>-<coleção>, produto-<id>, post-<id>).
+# Toda invalidação chama os hooks registrados com as chaves afetadas. Com PURGE_URL definido,
+# o hook padrão envia um PURGE HTTP com as chaves no header PURGE_HEADER (Varnish xkey, Fastly etc.).
+PURGE_URL = os.getenv("PURGE_URL", "")
+PURGE_HEADER = os.getenv("PURGE_HEADER", "Surrogate-Key")
+PURGE_TOKEN = os.getenv("PURGE_TOKEN", "")
+_purge_hooks = []
+
+def registrar_purge_hook(funcao):
+    # funcao(chaves) recebe a lista de surrogate keys a remover; pode ser usado como decorator
+    _purge_hooks.append(funcao)
+    return funcao
+
+def purgar(chaves):
+    for hook in _purge_hooks:
+        try:
+            hook(list(chaves))
+        except Exception as e:
+            print(f"Erro no purge {getattr(hook, '__name__', hook)}: {e}")
+
+def _enviar_purge(chaves):
+    headers = {PURGE_HEADER: " ".join(chaves)}
+    if PURGE_TOKEN: headers["Authorization"] = f"Bearer {PURGE_TOKEN}"
+    try:
+        r = requests.request("PURGE", PURGE_URL, headers=headers, timeout=5)
+        if r.status_code >= 400:
+            print(f"Purge recusado ({r.status_code}) para {chaves}")
+    except Exception as e:
+        print(f"Erro ao enviar purge para {PURGE_URL}: {e}")
+
+# Executor próprio: uma rajada de purges não atrasa as revalidações stale-while-revalidate
+_executor_purge = ThreadPoolExecutor(max_workers=2, thread_name_prefix="purge")
+
+if PURGE_URL:
+    # Fora da requisição: a edição no admin não espera o proxy
+    registrar_purge_hook(lambda chaves: _executor_purge.submit(_enviar_purge, chaves))
+
+def invalidar_loja(loja_id, *colecoes):
+    # Sem coleções informadas invalida todas as da loja
+    for c in colecoes or COLECOES_LOJA:
+        _incrementar_versao(f"versao_{loja_id}_{c}")
+    if 'lojas' in (colecoes or COLECOES_LOJA):
+        # Dados da própria loja mudaram: avisa os registros em memória de todos os workers
+        _incrementar_versao("versao_registro_lojas")
+        registro_lojas.atualizar_loja(loja_id)
+        purgar([f"loja-{loja_id}"])
+    else:
+        purgar([f"loja-{loja_id}-{c}" for c in colecoes])
+
+# HOSTS DO SAAS
+# Hosts que não são domínio próprio de cliente
+HOSTS_PRINCIPAIS = ['leanttro.com', 'www.leanttro.com', 'catalogo.leanttro.com', 'localhost', '127.0.0.1']
+# Hosts onde a raiz abre direto a loja tecnologia
+HOSTS_FALLBACK_TECNOLOGIA = ['leanttro.com', 'www.leanttro.com', 'localhost', '127.0.0.1']
+
+# REGISTRO DE LOJAS EM MEMÓRIA
+# Cada worker carrega a coleção lojas uma única vez e indexa por slug e por domínio próprio.
+# Um thread em segundo plano aplica só as lojas alteradas desde a última sincronização (date_updated)
+# e de tempos em tempos recarrega tudo para refletir lojas removidas.
+REGISTRO_LOJAS_INTERVALO = int(os.getenv("REGISTRO_LOJAS_INTERVALO", 30)) # segundos entre deltas
+REGISTRO_LOJAS_RECARGA_TOTAL = int(os.getenv("REGISTRO_LOJAS_RECARGA_TOTAL", 600)) # segundos entre recargas completas
+# Tempo que um host/slug inexistente fica marcado como desconhecido quando o registro ainda não carregou
+LOJA_NEGATIVA_TTL = int(os.getenv("LOJA_NEGATIVA_TTL", 60))
+# Validade das entradas stale-while-revalidate da identidade da loja
+IDENTIDADE_TTL_FRESCO = int(os.getenv("IDENTIDADE_TTL_FRESCO", 300))
+IDENTIDADE_TTL_MAXIMO = int(os.getenv("IDENTIDADE_TTL_MAXIMO", 86400))
+
+def normalizar_dominio(dominio):
+    # Normaliza domínio para comparação Remove protocolo, barra final, porta e www
+    if not dominio: return ""
+    dominio = str(dominio).strip().lower()
+    dominio = re.sub(r'^https?://', '', dominio).split('/')[0].split(':')[0]
+    if dominio.startswith('www.'): dominio = dominio[4:]
+    return dominio
+
+class RegistroLojas:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._por_id = {}
+        self._por_slug = {}
+        self._por_dominio = {}
+        self._marca_delta = "" # Maior date_updated/date_created já visto (horário do Directus)
+        self._pid = None
+        self.carregado = False
+        self.ultima_sincronizacao = 0.0
+        self.ultima_recarga_total = 0.0
+        self.ultimo_erro = None
+        self._versao_vista = None
+        self._acordar = threading.Event()
+
+    def _buscar(self, filtros=""):
+        url = f"{DIRECTUS_URL}/items/lojas?limit=-1&fields=*{filtros}"
+        resp = directus.get(url, timeout=15)
+        resp.raise_for_status()
+        return resp.json()['data']
+
+    def _indexar(self, loja):
+        # Remove as chaves antigas da loja caso o slug ou domínio tenham mudado
+        antiga = self._por_id.get(loja['id'])
+        if antiga:
+            if self._por_slug.get(antiga.get('slug')) is antiga:
+                self._por_slug.pop(antiga.get('slug'), None)
+            dominio_antigo = normalizar_dominio(antiga.get('dominio_proprio'))
+            if self._por_dominio.get(dominio_antigo) is antiga:
+                self._por_dominio.pop(dominio_antigo, None)
+
+        self._por_id[loja['id']] = loja
+        if loja.get('slug'):
+            self._por_slug[loja['slug']] = loja
+        dominio = normalizar_dominio(loja.get('dominio_proprio'))
+        if dominio:
+            self._por_dominio[dominio] = loja
+
+        for campo in ('date_updated', 'date_created'):
+            if loja.get(campo) and loja[campo] > self._marca_delta:
+                self._marca_delta = loja[campo]
+
+    def recarregar(self):
+        # Carga completa Substitui os índices de uma vez
+        lojas = self._buscar()
+        with self._lock:
+            self._por_id, self._por_slug, self._por_dominio = {}, {}, {}
+            self._marca_delta = ""
+            for loja in lojas:
+                self._indexar(loja)
+            self.carregado = True
+            self.ultima_sincronizacao = self.ultima_recarga_total = time.time()
+            self.ultimo_erro = None
+
+    def sincronizar_delta(self):
+        # Busca apenas lojas criadas ou alteradas depois da última marca conhecida
+        marca = self._marca_delta
+        if not marca:
+            return self.recarregar()
+        lojas = self._buscar(f"&filter[_or][0][date_updated][_gt]={marca}&filter[_or][1][date_created][_gt]={marca}")
+        with self._lock:
+            for loja in lojas:
+                self._indexar(loja)
+            self.ultima_sincronizacao = time.time()
+            self.ultimo_erro = None
+
+    def sincronizar(self):
+        try:
+            if not self.carregado or time.time() - self.ultima_recarga_total >= REGISTRO_LOJAS_RECARGA_TOTAL:
+                self.recarregar()
+            else:
+                self.sincronizar_delta()
+        except Exception as e:
+            self.ultimo_erro = str(e)
+            print(f"Erro ao sincronizar registro de lojas: {e}")
+
+    def atualizar_loja(self, loja_id):
+        # Recarrega uma única loja logo após uma alteração feita por este worker
+        try:
+            resp = directus.get(f"{DIRECTUS_URL}/items/lojas/{loja_id}?fields=*", timeout=7)
+            with self._lock:
+                if resp.status_code == 200 and resp.json().get('data'):
+                    self._indexar(resp.json()['data'])
+                else:
+                    self._remover(loja_id)
+        except Exception as e:
+            print(f"Erro ao atualizar loja {loja_id} no registro: {e}")
+        self._versao_vista = cache.get("versao_registro_lojas")
+
+    def _remover(self, loja_id):
+        antiga = self._por_id.pop(loja_id, None)
+        if antiga:
+            if self._por_slug.get(antiga.get('slug')) is antiga:
+                self._por_slug.pop(antiga.get('slug'), None)
+            dominio = normalizar_dominio(antiga.get('dominio_proprio'))
+            if self._por_dominio.get(dominio) is antiga:
+                self._por_dominio.pop(dominio, None)
+
+    def verificar_versao(self):
+        # Outro worker alterou uma loja: antecipa o próximo ciclo da thread em vez de sincronizar
+        # na thread da requisição, que segue com o registro atual
+        versao = cache.get("versao_registro_lojas")
+        if versao != self._versao_vista:
+            self._versao_vista = versao
+            self._acordar.set()
+
+    def _loop(self):
+        # A primeira carga também roda aqui: até ela terminar o before_request usa o Directus direto
+        while True:
+            self.sincronizar()
+            self._acordar.wait(REGISTRO_LOJAS_INTERVALO)
+            self._acordar.clear()
+
+    def garantir_ativo(self):
+        # Inicia o registro no worker atual Após o fork do gunicorn cada processo carrega o seu
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.carregado = False
+            self._versao_vista = cache.get("versao_registro_lojas")
+            self._acordar = threading.Event()
+            threading.Thread(target=self._loop, name="registro-lojas", daemon=True).start()
+
+    def por_slug(self, slug):
+        loja = self._por_slug.get(slug)
+        return dict(loja) if loja else None
+
+    def por_dominio(self, host):
+        loja = self._por_dominio.get(normalizar_dominio(host))
+        return dict(loja) if loja else None
+
+    def status(self):
+        return {
+            "carregado": self.carregado,
+            "lojas": len(self._por_id),
+            "dominios": len(self._por_dominio),
+            "atraso_segundos": round(time.time() - self.ultima_sincronizacao, 1) if self.ultima_sincronizacao else None,
+            "ultima_recarga_total": datetime.utcfromtimestamp(self.ultima_recarga_total).isoformat() if self.ultima_recarga_total else None,
+            "marca_delta": self._marca_delta or None,
+            "ultimo_erro": self.ultimo_erro,
+            "pid": os.getpid()
+        }
+
+registro_lojas = RegistroLojas()
+
+def resolver_loja_registro(host, primeiro_segmento):
+    # Mesma prioridade da busca no Directus, mas resolvida em memória
+    if host not in HOSTS_PRINCIPAIS:
+        loja = registro_lojas.por_dominio(host)
+        if loja: return loja, loja.get('slug')
+
+    if primeiro_segmento and primeiro_segmento not in BLACKLIST_ROTAS:
+        loja = registro_lojas.por_slug(primeiro_segmento)
+        if loja: return loja, primeiro_segmento
+
+    if host in HOSTS_FALLBACK_TECNOLOGIA and primeiro_segmento not in BLACKLIST_ROTAS:
+        loja = registro_lojas.por_slug("tecnologia")
+        if loja: return loja, "tecnologia"
+
+    return None, None
+
+def resolver_loja_directus(host, primeiro_segmento):
+    # Caminho antigo consultando o Directus Usado enquanto o registro não carregou
+    # Retorna também se todas as consultas responderam, para só cachear "não encontrado" confiável
+    loja_encontrada = None
+    slug_atual = None
+    consultas_ok = True
+
+    # 1 VERIFICAÇÃO DE DOMÍNIO PRÓPRIO
+    # Se não for o domínio principal do SaaS nem localhost
+    # NOTA: hosts com domínio próprio de clientes são identificados aqui
+    if host not in HOSTS_PRINCIPAIS:
+        try:
+            host_clean = host.replace('www.', '')
+            url = f"{DIRECTUS_URL}/items/lojas?filter[_or][0][dominio_proprio][_eq]={host_clean}&filter[_or][1][dominio_proprio][_eq]=www.{host_clean}&fields=*"
+            resp = directus.get(url, timeout=7)
+            if resp.status_code == 200 and len(resp.json()['data']) > 0:
+                loja_encontrada = resp.json()['data'][0]
+                slug_atual = loja_encontrada.get('slug') # Define o slug mesmo estando em domínio próprio
+            elif resp.status_code != 200:
+                consultas_ok = False
+        except Exception as e:
+            consultas_ok = False
+            print(f"Erro Middleware Domínio: {e}")
+
+    # 2 VERIFICAÇÃO DE PATH SLUG
+    # Se não achou por domínio tenta pelo primeiro segmento da URL
+    # Verifica se o primeiro segmento NÃO é uma palavra reservada
+    if not loja_encontrada and primeiro_segmento and primeiro_segmento not in BLACKLIST_ROTAS:
+        try:
+            url = f"{DIRECTUS_URL}/items/lojas?filter[slug][_eq]={primeiro_segmento}&fields=*"
+            resp = directus.get(url, timeout=7)
+            if resp.status_code == 200 and len(resp.json()['data']) > 0:
+                loja_encontrada = resp.json()['data'][0]
+                slug_atual = primeiro_segmento
+            elif resp.status_code != 200:
+                consultas_ok = False
+        except Exception as e:
+            consultas_ok = False
+            print(f"Erro Middleware Slug: {e}")
+
+    # 3 FALLBACK PARA DOMÍNIO PRINCIPAL -> TECNOLOGIA (ABRE DIRETO NO DOMÍNIO)
+    if not loja_encontrada and host in HOSTS_FALLBACK_TECNOLOGIA and primeiro_segmento not in BLACKLIST_ROTAS:
+        try:
+            url = f"{DIRECTUS_URL}/items/lojas?filter[slug][_eq]=tecnologia&fields=*"
+            resp = directus.get(url, timeout=7)
+            if resp.status_code == 200 and len(resp.json()['data']) > 0:
+                loja_encontrada = resp.json()['data'][0]
+                slug_atual = "tecnologia"
+            elif resp.status_code != 200:
+                consultas_ok = False
+        except Exception as e:
+            consultas_ok = False
+            print(f"Erro Middleware Tecnologia Fallback: {e}")
+
+    return loja_encontrada, slug_atual, consultas_ok
+
 # MIDDLEWARE IDENTIFICAÇÃO DA LOJA DOMÍNIO OU PATH
 @app.before_request
 def identificar_loja():
@@ -200,53 +1085,32 @@ def identificar_loja():
     path_parts = request.path.strip('/').split('/')
     primeiro_segmento = path_parts[0] if path_parts else ""
 
-    cache_key = f"loja_identidade_{host}_{primeiro_segmento}"
-    loja_encontrada = cache.get(cache_key)
-
-    if not loja_encontrada:
-        headers = get_headers()
-
-        # 1 VERIFICAÇÃO DE DOMÍNIO PRÓPRIO
-        # Se não for o domínio principal do SaaS nem localhost
-        # NOTA: hosts com domínio próprio de clientes são identificados aqui
-        if host not in ['leanttro.com', 'www.leanttro.com', 'catalogo.leanttro.com', 'localhost', '127.0.0.1'] or \
-           host in ['creapes.com.br', 'www.creapes.com.br']:
-            try:
-                host_clean = host.replace('www.', '')
-                url = f"{DIRECTUS_URL}/items/lojas?filter[_or][0][dominio_proprio][_eq]={host_clean}&filter[_or][1][dominio_proprio][_eq]=www.{host_clean}&fields=*"
-                resp = requests.get(url, headers=headers, timeout=7)
-                if resp.status_code == 200 and len(resp.json()['data']) > 0:
-                    loja_encontrada = resp.json()['data'][0]
-                    g.slug_atual = loja_encontrada.get('slug') # Define o slug mesmo estando em domínio próprio
-            except Exception as e:
-                print(f"Erro Middleware Domínio: {e}")
-
-        # 2 VERIFICAÇÃO DE PATH SLUG
-        # Se não achou por domínio tenta pelo primeiro segmento da URL
-        # Verifica se o primeiro segmento NÃO é uma palavra reservada
-        if not loja_encontrada and primeiro_segmento and primeiro_segmento not in BLACKLIST_ROTAS:
-            g.slug_atual = primeiro_segmento
-            try:
-                url = f"{DIRECTUS_URL}/items/lojas?filter[slug][_eq]={g.slug_atual}&fields=*"
-                resp = requests.get(url, headers=headers, timeout=7)
-                if resp.status_code == 200 and len(resp.json()['data']) > 0:
-                    loja_encontrada = resp.json()['data'][0]
-            except Exception as e:
-                print(f"Erro Middleware Slug: {e}")
+    # Registro em memória: a resolução vira uma consulta em dicionário
+    registro_lojas.garantir_ativo()
+    if registro_lojas.carregado:
+        registro_lojas.verificar_versao()
+        loja_encontrada, g.slug_atual = resolver_loja_registro(host, primeiro_segmento)
+    else:
+        # Com o registro carregado um miss já não sai do processo Aqui o "não encontrado" também é cacheado
+        chave_negativa = f"loja_inexistente_{host}_{primeiro_segmento}"
+        loja_encontrada = None
+        if not cache.get(chave_negativa):
+            def construir_identidade():
+                loja, slug, consultas_ok = resolver_loja_directus(host, primeiro_segmento)
+                if not loja and not consultas_ok:
+                    raise RuntimeError("Directus indisponível ao identificar a loja")
+                return (loja, slug) if loja else None
 
-        # 3 FALLBACK PARA DOMÍNIO PRINCIPAL -> TECNOLOGIA (ABRE DIRETO NO DOMÍNIO)
-        if not loja_encontrada and host in ['leanttro.com', 'www.leanttro.com', 'localhost', '127.0.0.1'] and primeiro_segmento not in BLACKLIST_ROTAS:
-            g.slug_atual = "tecnologia"
             try:
-                url = f"{DIRECTUS_URL}/items/lojas?filter[slug][_eq]=tecnologia&fields=*"
-                resp = requests.get(url, headers=headers, timeout=7)
-                if resp.status_code == 200 and len(resp.json()['data']) > 0:
-                    loja_encontrada = resp.json()['data'][0]
+                versao = cache.get("versao_registro_lojas") or 0
+                identidade = cache_swr(f"loja_identidade_{versao}_{host}_{primeiro_segmento}", construir_identidade,
+                                       IDENTIDADE_TTL_FRESCO, IDENTIDADE_TTL_MAXIMO)
+                if identidade:
+                    loja_encontrada, g.slug_atual = identidade
+                else:
+                    cache.set(chave_negativa, True, timeout=LOJA_NEGATIVA_TTL)
             except Exception as e:
-                print(f"Erro Middleware Tecnologia Fallback: {e}")
-        
-        if loja_encontrada:
-            cache.set(cache_key, loja_encontrada, timeout=300)
+                print(f"Erro ao identificar loja: {e}")
 
     # SE A LOJA FOI IDENTIFICADA Por Domínio ou Slug configura o ambiente
     if loja_encontrada:
@@ -266,11 +1130,244 @@ def identificar_loja():
         g.layout_list = g.loja['layout_order'].split(',')
         
         # Adiciona URL base para templates Se for domínio próprio ou tecnologia no domínio principal, base é vazia
-        if g.slug_atual == "tecnologia" and host in ['leanttro.com', 'www.leanttro.com', 'localhost', '127.0.0.1']:
+        if g.slug_atual == "tecnologia" and host in HOSTS_FALLBACK_TECNOLOGIA:
             g.loja['base_url'] = ""
         else:
             g.loja['base_url'] = f"/{g.slug_atual}"
 
+# COMPRESSÃO DE RESPOSTAS
+# gzip (e brotli, se o pacote estiver instalado) escolhido pelo Accept-Encoding.
+# Páginas em cache guardam as versões comprimidas junto do HTML e os arquivos de texto do
+# /static são comprimidos uma vez na subida, então nenhum acerto comprime de novo.
+COMPRESSAO_MINIMA = 1024 # bytes; abaixo disso não compensa
+TIPOS_COMPRIMIVEIS = {'text/html', 'text/css', 'text/plain', 'text/xml', 'application/xml',
+                      'application/json', 'application/javascript', 'text/javascript', 'image/svg+xml'}
+CODIFICACOES = ('br', 'gzip') if brotli else ('gzip',)
+
+def escolher_codificacao():
+    return request.accept_encodings.best_match(CODIFICACOES)
+
+def comprimir(corpo, maximo=False):
+    # {codificação: bytes} para todas as codificações suportadas
+    variantes = {'gzip': gzip.compress(corpo, compresslevel=9 if maximo else 6)}
+    if brotli:
+        variantes['br'] = brotli.compress(corpo, quality=11 if maximo else 5)
+    return variantes
+
+def etag_conteudo(corpo):
+    return hashlib.sha1(corpo).hexdigest()
+
+def etag_codificada(etag, codificacao):
+    # ETag forte precisa mudar junto com os bytes enviados
+    return f"{etag}-{codificacao}" if codificacao else etag
+
+def _precomprimir_estaticos():
+    arquivos = {}
+    for raiz, _, nomes in os.walk(app.static_folder):
+        for nome in nomes:
+            caminho = os.path.join(raiz, nome)
+            tipo = mimetypes.guess_type(nome)[0]
+            if tipo not in TIPOS_COMPRIMIVEIS or os.path.getsize(caminho) < COMPRESSAO_MINIMA:
+                continue
+            with open(caminho, 'rb') as f:
+                conteudo = f.read()
+            arquivos[os.path.relpath(caminho, app.static_folder).replace(os.sep, '/')] = {
+                "tipo": tipo, "mtime": os.path.getmtime(caminho), "etag": etag_conteudo(conteudo),
+                **comprimir(conteudo, maximo=True)
+            }
+    return arquivos
+
+_estaticos_comprimidos = _precomprimir_estaticos() if app.static_folder and os.path.isdir(app.static_folder) else {}
+
+@app.before_request
+def servir_estatico_comprimido():
+    prefixo = app.static_url_path + '/'
+    if request.method != 'GET' or not request.path.startswith(prefixo):
+        return
+    arquivo = _estaticos_comprimidos.get(request.path[len(prefixo):])
+    codificacao = escolher_codificacao()
+    if not arquivo or not codificacao:
+        return
+    caminho = os.path.join(app.static_folder, request.path[len(prefixo):])
+    if not os.path.exists(caminho) or os.path.getmtime(caminho) != arquivo["mtime"]:
+        return # arquivo mudou depois da subida, deixa o Flask servir o original
+    resposta = Response(arquivo[codificacao], mimetype=arquivo["tipo"])
+    resposta.headers['Content-Encoding'] = codificacao
+    resposta.headers['Vary'] = 'Accept-Encoding'
+    resposta.cache_control.public = True
+    resposta.cache_control.max_age = 3600
+    resposta.last_modified = datetime.fromtimestamp(arquivo["mtime"], timezone.utc)
+    resposta.set_etag(etag_codificada(arquivo["etag"], codificacao))
+    # Como no send_from_directory: If-None-Match / If-Modified-Since viram 304
+    return resposta.make_conditional(request)
+
+@app.after_request
+def comprimir_resposta(resposta):
+    if resposta.mimetype not in TIPOS_COMPRIMIVEIS or resposta.direct_passthrough or resposta.is_streamed:
+        return resposta
+    resposta.vary.add('Accept-Encoding')
+    codificacao = escolher_codificacao()
+    if not codificacao or resposta.status_code != 200 or 'Content-Encoding' in resposta.headers:
+        return resposta
+    # Página que acabou de ir para o cache já vem com as versões comprimidas
+    variantes = g.get('variantes_pagina')
+    if variantes is None:
+        corpo = resposta.get_data()
+        if len(corpo) < COMPRESSAO_MINIMA:
+            return resposta
+        variantes = comprimir(corpo)
+    resposta.set_data(variantes[codificacao])
+    resposta.headers['Content-Encoding'] = codificacao
+    etag, fraca = resposta.get_etag()
+    if etag and not fraca:
+        resposta.set_etag(etag_codificada(etag, codificacao))
+    return resposta
+
+# CACHE DE PÁGINAS RENDERIZADAS
+# Visitante anônimo recebe a mesma página para a mesma loja, caminho e parâmetros, então o HTML
+# pronto fica em cache. A chave leva a versão de todas as coleções da loja, assim qualquer
+# invalidar_loja também descarta as páginas. Quem tem cookie de sessão (admin, flash) sempre renderiza.
+PAGINA_CACHE_TTL = int(os.getenv("PAGINA_CACHE_TTL", 600))
+ROTAS_CACHE_PAGINA = {'home_saas', 'index', 'produto', 'personagem_wanted', 'case_page', 'blog_post'}
+# Só parâmetros que mudam a página entram na chave (utm_*, fbclid etc. não fragmentam o cache).
+# Buscas não são guardadas: o texto é livre e a consulta já sai do índice em memória da vitrine.
+PARAMETROS_PAGINA = ('categoria',)
+FORMATO_PAGINA = 2 # muda quando o formato da entrada muda (evita ler entradas antigas após deploy)
+
+def chave_pagina():
+    parametros = "&".join(f"{k}={v}" for k in PARAMETROS_PAGINA for v in sorted(request.args.getlist(k)))
+    host = request.host.split(':')[0].lower()
+    return f"pagina_{FORMATO_PAGINA}_{host}_{request.path}_{parametros}_{versao_loja(g.loja_id, COLECOES_LOJA)}"
+
+def pagina_cacheavel():
+    return (request.method == 'GET' and request.endpoint in ROTAS_CACHE_PAGINA
+            and g.get('loja') is not None and 'busca' not in request.args
+            and app.config['SESSION_COOKIE_NAME'] not in request.cookies)
+
+def marcar_degradada():
+    # Render feito com dados de fallback (Directus indisponível): não vai para o cache de páginas,
+    # não recebe validadores e sai com no-store para navegador e CDN
+    if has_request_context():
+        g.resposta_degradada = True
+
+# RESPOSTAS CONDICIONAIS (ETag / Last-Modified)
+# A ETag é o hash do HTML/XML que foi de fato renderizado, então qualquer mudança de conteúdo
+# (edição direta no Directus, revalidação em segundo plano, deploy) muda o validador.
+# Acertos do cache de páginas respondem 304 sem render; renders com fallback não levam validador.
+ENDPOINTS_VALIDADOS = ROTAS_CACHE_PAGINA | {'sitemap'}
+
+def nao_modificado(etag, momento):
+    if request.if_none_match:
+        # Aceita a ETag de qualquer codificação do mesmo conteúdo
+        return any(request.if_none_match.contains(etag_codificada(etag, c)) for c in (None,) + CODIFICACOES)
+    if request.if_modified_since:
+        return int(request.if_modified_since.timestamp()) >= int(momento)
+    return False
+
+def responder_304(resposta, etag, momento, tamanho):
+    # Converte a resposta em 304 mantendo os cabeçalhos de cache e a ETag da codificação que o cliente receberia
+    codificacao = escolher_codificacao() if tamanho >= COMPRESSAO_MINIMA and resposta.mimetype in TIPOS_COMPRIMIVEIS else None
+    resposta.status_code = 304
+    resposta.set_data(b'')
+    for cabecalho in ('Content-Length', 'Content-Encoding'):
+        resposta.headers.pop(cabecalho, None)
+    resposta.set_etag(etag_codificada(etag, codificacao))
+    resposta.last_modified = datetime.fromtimestamp(int(momento), timezone.utc)
+    resposta.vary.add('Accept-Encoding')
+    return resposta
+
+@app.after_request
+def aplicar_validadores(resposta):
+    if (request.method != 'GET' or request.endpoint not in ENDPOINTS_VALIDADOS or resposta.status_code != 200
+            or g.get('resposta_degradada') or resposta.is_streamed or resposta.direct_passthrough):
+        return resposta
+    if 'Content-Encoding' in resposta.headers:
+        # Acerto do cache de páginas: validadores já calculados quando a página foi guardada
+        etag, momento = g.get('validadores_pagina') or (None, None)
+        if not etag:
+            return resposta
+        resposta.set_etag(etag_codificada(etag, resposta.headers['Content-Encoding']))
+    else:
+        corpo = resposta.get_data()
+        etag, momento = g.get('validadores_pagina') or (etag_conteudo(corpo), time.time())
+        if nao_modificado(etag, momento):
+            return responder_304(resposta, etag, momento, len(corpo))
+        resposta.set_etag(etag)
+    resposta.last_modified = datetime.fromtimestamp(int(momento), timezone.utc)
+    return resposta
+
+@app.before_request
+def servir_pagina_em_cache():
+    g.chave_pagina = None
+    if not pagina_cacheavel():
+        return
+    g.chave_pagina = chave_pagina()
+    entrada = cache.get(g.chave_pagina)
+    if entrada is not None:
+        g.chave_pagina = None
+        g.chaves_surrogate = entrada.get("surrogate")
+        g.validadores_pagina = (entrada["etag"], entrada["momento"])
+        codificacao = escolher_codificacao()
+        variantes = entrada.get("variantes") or {}
+        if codificacao in variantes:
+            resposta = Response(variantes[codificacao], status=entrada["status"], mimetype=entrada["tipo"])
+            resposta.headers['Content-Encoding'] = codificacao
+        else:
+            resposta = Response(entrada["corpo"], status=entrada["status"], mimetype=entrada["tipo"])
+        resposta.headers['X-Cache'] = 'HIT'
+        if nao_modificado(entrada["etag"], entrada["momento"]):
+            return responder_304(resposta, entrada["etag"], entrada["momento"], len(entrada["corpo"]))
+        return resposta
+
+@app.after_request
+def guardar_pagina_em_cache(resposta):
+    if g.get('resposta_degradada'):
+        resposta.headers['Cache-Control'] = 'no-store'
+        return resposta
+    # Não guarda respostas que mexeram na sessão ou gravam cookie
+    if (g.get('chave_pagina') and resposta.status_code == 200 and not resposta.direct_passthrough
+            and not session.modified and 'Set-Cookie' not in resposta.headers):
+        corpo = resposta.get_data()
+        g.variantes_pagina = comprimir(corpo) if len(corpo) >= COMPRESSAO_MINIMA else None
+        g.validadores_pagina = (etag_conteudo(corpo), time.time())
+        cache.set(g.chave_pagina, {
+            "corpo": corpo,
+            "status": resposta.status_code,
+            "tipo": resposta.mimetype,
+            "variantes": g.variantes_pagina or {},
+            "surrogate": g.get('chaves_surrogate') or [],
+            "etag": g.validadores_pagina[0],
+            "momento": g.validadores_pagina[1]
+        }, timeout=PAGINA_CACHE_TTL)
+        resposta.headers['X-Cache'] = 'MISS'
+    return resposta
+
+# CABEÇALHOS PARA CACHE DE BORDA
+# Páginas anônimas podem ficar no CDN/proxy; a remoção é feita por purge nas Surrogate-Keys
+# quando a loja muda (ver invalidar_loja).
+CDN_S_MAXAGE = int(os.getenv("CDN_S_MAXAGE", 300))
+CDN_STALE = int(os.getenv("CDN_STALE", 86400))
+
+def chaves_surrogate(loja_id, colecoes):
+    return [f"loja-{loja_id}"] + [f"loja-{loja_id}-{c}" for c in colecoes]
+
+def marcar_surrogate(*chaves):
+    g.chaves_surrogate = list(dict.fromkeys((g.get('chaves_surrogate') or []) + list(chaves)))
+
+@app.after_request
+def aplicar_cabecalhos_cdn(resposta):
+    if not (g.get('chaves_surrogate') and resposta.status_code == 200
+            and (request.endpoint == 'sitemap' or pagina_cacheavel())):
+        return resposta
+    # O CDN guardaria o cookie de um visitante e entregaria para os outros
+    resposta.vary.add('Cookie')
+    if session.modified or 'Set-Cookie' in resposta.headers or g.get('resposta_degradada'):
+        resposta.headers['Cache-Control'] = 'private, no-store'
+        return resposta
+    resposta.headers['Surrogate-Key'] = " ".join(g.chaves_surrogate)
+    resposta.headers['Cache-Control'] = f"public, max-age=0, s-maxage={CDN_S_MAXAGE}, stale-while-revalidate={CDN_STALE}"
+    return resposta
+
 # ROTA RAIZ DO SAAS
 @app.route('/')
 def home_saas():
@@ -299,26 +1396,89 @@ def landing_page_rota():
 # ───────────────────────────────────────────────────────────────
 # ROTA SITEMAP DINÂMICO
 # ───────────────────────────────────────────────────────────────
+# Sitemap completo da loja: produtos e posts são paginados por id até o último item.
+# A lista de URLs fica em cache por loja e versão; acima de SITEMAP_MAX_URLS o /sitemap.xml vira um
+# índice que aponta para ?parte=N. Cada arquivo XML também fica em cache, já com as versões comprimidas
+# e a ETag, e sai como resposta normal (gzip/brotli e 304 como as páginas).
+SITEMAP_MAX_URLS = 50000 # limite do protocolo por arquivo
+SITEMAP_LOTE = 2000 # itens por página na consulta ao Directus
+SITEMAP_TTL_FRESCO = int(os.getenv("SITEMAP_TTL_FRESCO", 3600))
+SITEMAP_TTL_MAXIMO = 86400
+
+def _itens_publicados(colecao, loja_id):
+    # Paginação por id (keyset): custo constante por página mesmo em catálogos grandes
+    ultimo = None
+    while True:
+        filtro = {"loja_id": {"_eq": loja_id}, "status": {"_eq": "published"}}
+        if ultimo is not None: filtro["id"] = {"_gt": ultimo}
+        lote = _buscar_rest(Consulta(colecao, filtro, sort=["id"], limit=SITEMAP_LOTE, campos=["id"] + CAMPOS_SITEMAP))
+        yield from lote
+        if len(lote) < SITEMAP_LOTE:
+            return
+        ultimo = lote[-1]['id']
+
+def montar_urls_sitemap(loja_id, url_base, prefixo):
+    # [(loc, lastmod, changefreq, priority)] sem a home (que usa a data do dia)
+    urls = []
+    for p in _itens_publicados("produtos", loja_id):
+        if not p.get('slug'): continue
+        lastmod = (p.get('date_updated') or p.get('date_created') or '')[:10]
+        urls.append((f"{url_base}{prefixo}/tecnologia/produto/{p['slug']}", lastmod, "monthly", "0.8"))
+    for post in _itens_publicados("posts", loja_id):
+        if not post.get('slug'): continue
+        lastmod = (post.get('date_updated') or post.get('date_created') or '')[:10]
+        urls.append((f"{url_base}{prefixo}/blog/{post['slug']}", lastmod, "monthly", "0.6"))
+    return urls
+
+def _xml_urlset(urls, hoje):
+    partes = ['<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+    for loc, lastmod, changefreq, priority in urls:
+        partes.append(f"""  <url>
+    <loc>{escape_xml(loc)}</loc>
+    <lastmod>{lastmod or hoje}</lastmod>
+    <changefreq>{changefreq}</changefreq>
+    <priority>{priority}</priority>
+  </url>
+""")
+    partes.append('</urlset>')
+    return "".join(partes)
+
+def _xml_indice_sitemap(url_sitemap, partes, hoje):
+    itens = "".join(f"  <sitemap>\n    <loc>{escape_xml(url_sitemap)}?parte={n}</loc>\n    <lastmod>{hoje}</lastmod>\n  </sitemap>\n"
+                    for n in range(1, partes + 1))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n' + itens + '</sitemapindex>'
+
 @app.route('/sitemap.xml')
 @app.route('/<loja_slug>/sitemap.xml')
 def sitemap(loja_slug=None):
-    headers_req = get_headers()
     BASE = "https://www.leanttro.com"
     hoje = datetime.utcnow().strftime('%Y-%m-%d')
 
     slug = loja_slug or "tecnologia"
 
-    try:
-        r_loja = requests.get(
-            f"{DIRECTUS_URL}/items/lojas?filter[slug][_eq]={slug}&fields=id,slug,dominio_proprio",
-            headers=headers_req, timeout=7
-        )
-        if r_loja.status_code != 200 or not r_loja.json()['data']:
+    # Slug desconhecido é respondido pelo registro em memória sem consultar o Directus
+    registro_lojas.garantir_ativo()
+    if registro_lojas.carregado:
+        loja_data = registro_lojas.por_slug(slug)
+        if not loja_data:
             return Response("Loja não encontrada", status=404)
-        loja_data = r_loja.json()['data'][0]
-        loja_id = loja_data['id']
-    except Exception as e:
-        return Response(f"Erro: {e}", status=500)
+    else:
+        if cache.get(f"loja_inexistente_sitemap_{slug}"):
+            return Response("Loja não encontrada", status=404)
+        try:
+            r_loja = directus.get(
+                f"{DIRECTUS_URL}/items/lojas?filter[slug][_eq]={slug}&fields=id,slug,dominio_proprio",
+                timeout=7
+            )
+            if r_loja.status_code == 200 and not r_loja.json()['data']:
+                cache.set(f"loja_inexistente_sitemap_{slug}", True, timeout=LOJA_NEGATIVA_TTL)
+            if r_loja.status_code != 200 or not r_loja.json()['data']:
+                return Response("Loja não encontrada", status=404)
+            loja_data = r_loja.json()['data'][0]
+        except Exception as e:
+            return Response(f"Erro: {e}", status=500)
+    loja_id = loja_data['id']
+    marcar_surrogate(*chaves_surrogate(loja_id, ('produtos', 'posts')))
 
     dominio_proprio = loja_data.get('dominio_proprio', '')
     if dominio_proprio:
@@ -331,67 +1491,47 @@ def sitemap(loja_slug=None):
         url_base = BASE
         prefixo = f"/{slug}"
 
-    urls = []
-
-    urls.append({
-        "loc": f"{url_base}{prefixo}/",
-        "lastmod": hoje,
-        "priority": "1.0",
-        "changefreq": "weekly"
-    })
-
-    try:
-        r_prod = requests.get(
-            f"{DIRECTUS_URL}/items/produtos?filter[loja_id][_eq]={loja_id}&filter[status][_eq]=published&fields=slug,date_updated,date_created&limit=200",
-            headers=headers_req, timeout=10
-        )
-        if r_prod.status_code == 200:
-            for p in r_prod.json()['data']:
-                slug_prod = p.get('slug')
-                if not slug_prod:
-                    continue
-                lastmod = (p.get('date_updated') or p.get('date_created') or hoje)[:10]
-                urls.append({
-                    "loc": f"{url_base}{prefixo}/tecnologia/produto/{slug_prod}",
-                    "lastmod": lastmod,
-                    "priority": "0.8",
-                    "changefreq": "monthly"
-                })
-    except Exception as e:
-        print(f"Sitemap erro produtos: {e}")
-
+    chave = f"sitemap_{loja_id}_{versao_loja(loja_id, ('lojas', 'produtos', 'posts'))}"
     try:
-        r_posts = requests.get(
-            f"{DIRECTUS_URL}/items/posts?filter[loja_id][_eq]={loja_id}&filter[status][_eq]=published&fields=slug,date_updated,date_created&limit=200",
-            headers=headers_req, timeout=10
-        )
-        if r_posts.status_code == 200:
-            for post in r_posts.json()['data']:
-                slug_post = post.get('slug')
-                if not slug_post:
-                    continue
-                lastmod = (post.get('date_updated') or post.get('date_created') or hoje)[:10]
-                urls.append({
-                    "loc": f"{url_base}{prefixo}/blog/{slug_post}",
-                    "lastmod": lastmod,
-                    "priority": "0.6",
-                    "changefreq": "monthly"
-                })
+        urls = cache_swr(chave, lambda: montar_urls_sitemap(loja_id, url_base, prefixo),
+                         SITEMAP_TTL_FRESCO, SITEMAP_TTL_MAXIMO)
     except Exception as e:
-        print(f"Sitemap erro posts: {e}")
-
-    xml_parts = ['<?xml version="1.0" encoding="UTF-8"?>']
-    xml_parts.append('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">')
-    for u in urls:
-        xml_parts.append(f"""  <url>
-    <loc>{u['loc']}</loc>
-    <lastmod>{u['lastmod']}</lastmod>
-    <changefreq>{u['changefreq']}</changefreq>
-    <priority>{u['priority']}</priority>
-  </url>""")
-    xml_parts.append('</urlset>')
+        # Melhor o robô tentar de novo do que receber um sitemap pela metade
+        print(f"Sitemap erro: {e}")
+        return Response("Sitemap temporariamente indisponível", status=503, headers={"Retry-After": "300"})
+
+    # A home vai na primeira posição do primeiro arquivo
+    partes = (len(urls) + 1 + SITEMAP_MAX_URLS - 1) // SITEMAP_MAX_URLS
+    parte = request.args.get('parte', type=int)
+    # As partes ficam na mesma rota que respondeu o índice
+    indice = parte is None and partes > 1
+    if parte is None:
+        parte = 1
+    if not indice and not 1 <= parte <= partes:
+        return Response("Parte do sitemap não encontrada", status=404)
+
+    chave_xml = f"{chave}_xml_{hoje}_{'indice' if indice else parte}_{request.base_url}"
+    entrada = cache.get(chave_xml)
+    if entrada is None:
+        if indice:
+            xml = _xml_indice_sitemap(request.base_url, partes, hoje)
+        else:
+            urls = [(f"{url_base}{prefixo}/", hoje, "weekly", "1.0")] + urls
+            inicio = (parte - 1) * SITEMAP_MAX_URLS
+            xml = _xml_urlset(urls[inicio:inicio + SITEMAP_MAX_URLS], hoje)
+        corpo = xml.encode('utf-8')
+        entrada = {
+            "corpo": corpo,
+            "variantes": comprimir(corpo) if len(corpo) >= COMPRESSAO_MINIMA else None,
+            "etag": etag_conteudo(corpo),
+            "momento": time.time()
+        }
+        cache.set(chave_xml, entrada, timeout=SITEMAP_TTL_FRESCO)
 
-    return Response('\n'.join(xml_parts), mimetype='application/xml')
+    # comprimir_resposta e aplicar_validadores reaproveitam o que ficou em cache
+    g.variantes_pagina = entrada["variantes"]
+    g.validadores_pagina = (entrada["etag"], entrada["momento"])
+    return Response(entrada["corpo"], mimetype='application/xml')
 
 
 # ───────────────────────────────────────────────────────────────
@@ -406,181 +1546,529 @@ Sitemap: https://www.leanttro.com/sitemap.xml
 """
     return Response(content, mimetype='text/plain')
 
+# VIEW-MODELS DE PRODUTO
+# Conversão do produto cru do Directus para a forma usada nos templates (URLs de imagem,
+# preço/estoque numéricos, categoria só pelo id). É feita uma vez por versão do produto
+# (id + date_updated + campos recebidos) e reaproveitada pela vitrine, detalhe, case e personagem.
+VM_PRODUTOS_MAX = int(os.getenv("VM_PRODUTOS_MAX", 5000)) # view-models mantidos por worker
+_vm_produtos = OrderedDict()
+_vm_lock = threading.Lock()
+
+def _montar_view_model(p):
+    try: sort_val = int(p.get('sort')) if p.get('sort') is not None else 999999
+    except: sort_val = 999999
+
+    try: preco_float = float(p.get('preco', 0))
+    except: preco_float = 0.0
+
+    try: estoque_val = int(p.get('estoque')) if p.get('estoque') is not None else 0
+    except: estoque_val = 0
+
+    cat_val = p.get('categoria_id')
+    if isinstance(cat_val, dict): cat_val = cat_val.get('id')
+
+    imagens = {campo: get_img_url(p.get(campo)) for campo in
+               ('imagem_destaque', 'imagem1', 'imagem2', 'imagem3', 'imagem4', 'imagem5', 'imagem_secundaria')}
+
+    card = {
+        "id": p['id'], "nome": p['nome'], "slug": p['slug'],
+        "preco": preco_float,
+        "imagem": imagens['imagem_destaque'] or imagens['imagem1'],
+        "imagem1": imagens['imagem1'],
+        "imagem2": imagens['imagem2'],
+        "imagem_secundaria": imagens['imagem_secundaria'],
+        "imagem3": imagens['imagem3'],
+        "imagem4": imagens['imagem4'],
+        "imagem5": imagens['imagem5'],
+        "categoria_id": cat_val,
+        # Repassamos as variantes cruas, sem processar fotos
+        "variantes": p.get('variantes') or [], "origem": p.get('origem'),
+        "urgencia": p.get('status_urgencia'), "classe_frete": p.get('classe_frete'),
+        "estoque": estoque_val, "consulte": p.get('consulte', False),
+        "a_partir_de": p.get('a_partir_de', False),
+        "layout_case": p.get('layout_case', False),
+        "link_projeto": p.get('link_projeto'),
+        "whatsapp_projeto": p.get('whatsapp_projeto'),
+        "descricao": p.get('descricao'),
+        # Chave da ordenação da vitrine, usada pelos cursores de paginação
+        "ordem": (sort_val, p['id'])
+    }
+
+    # Página de detalhe recebe o produto completo com os mesmos tratamentos
+    galeria = [u for u in (imagens['imagem_destaque'], imagens['imagem1'], imagens['imagem2']) if u]
+    detalhe = {
+        **p, **imagens,
+        "categoria_id": cat_val,
+        "galeria": galeria or ["https://placehold.co/600x600?text=Sem+Imagem"],
+        "preco": preco_float,
+        "estoque": estoque_val,
+        "a_partir_de": p.get('a_partir_de', False),
+        "layout_case": p.get('layout_case', False)
+    }
+    return {"card": card, "detalhe": detalhe}
+
+def produto_view_model(p):
+    # Os view-models são compartilhados entre threads e não devem ser alterados por quem usa
+    versao = p.get('date_updated') or p.get('date_created')
+    if not versao:
+        return _montar_view_model(p)
+    chave = (p.get('id'), versao, tuple(sorted(p)))
+    with _vm_lock:
+        vm = _vm_produtos.get(chave)
+        if vm is not None:
+            _vm_produtos.move_to_end(chave)
+            return vm
+    vm = _montar_view_model(p)
+    with _vm_lock:
+        _vm_produtos[chave] = vm
+        while len(_vm_produtos) > VM_PRODUTOS_MAX:
+            _vm_produtos.popitem(last=False)
+    return vm
+
+# CACHE DE PRODUTOS E POSTS POR LOJA
+# Item completo (perfil de detalhe) por slug e por id, para as páginas de produto, personagem, case e blog,
+# e categorias avulsas (nome da categoria na página do post).
+# A reconstrução da vitrine grava os produtos publicados (perfil do card, que cobre os campos das páginas)
+# e os últimos posts, mas só o que mudou desde a última gravação. O resto entra na primeira visita.
+# A chave leva a versão das coleções de que a página depende, então qualquer edição descarta tudo.
+COLECOES_PRODUTO = ('produtos', 'categorias')
+COLECOES_POST = ('posts', 'categorias')
+ITEM_CACHE_TTL = int(os.getenv("ITEM_CACHE_TTL", 3600))
+# coleção -> (coleções da versão, perfil de campos)
+PERFIS_ITEM = {
+    "produtos": (COLECOES_PRODUTO, CAMPOS_PRODUTO_DETALHE),
+    "posts": (COLECOES_POST, CAMPOS_POST_DETALHE),
+    "categorias": (("categorias",), ["id", "nome", "slug"]),
+}
+
+def _chave_item(colecao, loja_id, versao, campo, valor):
+    return f"{colecao}_item_{loja_id}_{versao}_{campo}_{valor}"
+
+def versao_item(colecao, loja_id):
+    return versao_loja(loja_id, PERFIS_ITEM[colecao][0])
+
+def aquecer_itens_loja(colecao, loja_id, versao, itens):
+    entradas = {}
+    for item in itens:
+        if item.get('slug'): entradas[_chave_item(colecao, loja_id, versao, 'slug', item['slug'])] = item
+        if item.get('id') is not None: entradas[_chave_item(colecao, loja_id, versao, 'id', item['id'])] = item
+    if entradas:
+        # Reconstruções periódicas trazem os mesmos itens: regrava só o que mudou
+        atuais = dict(zip(entradas, cache.get_many(*entradas)))
+        entradas = {k: v for k, v in entradas.items() if atuais[k] != v}
+    if entradas:
+        try:
+            cache.set_many(entradas, timeout=ITEM_CACHE_TTL)
+        except Exception as e:
+            print(f"Erro ao aquecer {colecao} da loja {loja_id}: {e}")
+
+def item_da_loja(colecao, loja_id, campo, valor):
+    # Item cru (perfil de detalhe) ou None; só consulta o Directus quando não está em cache
+    versao = versao_item(colecao, loja_id)
+    chave = _chave_item(colecao, loja_id, versao, campo, valor)
+    item = cache.get(chave)
+    if item is not None:
+        return item or None
+
+    def buscar():
+        try:
+            itens = _buscar_rest(Consulta(colecao, {campo: {"_eq": valor}, "loja_id": {"_eq": loja_id}},
+                                          limit=1, campos=PERFIS_ITEM[colecao][1]))
+        except Exception as e:
+            print(f"Erro ao buscar {colecao} {campo}={valor}: {e}")
+            return None
+        if itens:
+            aquecer_itens_loja(colecao, loja_id, versao, itens)
+            return itens[0]
+        # Inexistente nesta versão: evita repetir a consulta para o mesmo link quebrado
+        cache.set(chave, False, timeout=LOJA_NEGATIVA_TTL)
+        return None
+
+    return coalescedor.executar(chave, buscar)
+
+def produto_da_loja(loja_id, slug=None, produto_id=None):
+    if slug is not None:
+        return item_da_loja("produtos", loja_id, 'slug', slug)
+    return item_da_loja("produtos", loja_id, 'id', produto_id)
+
+def post_da_loja(loja_id, slug):
+    return item_da_loja("posts", loja_id, 'slug', slug)
+
+# ÍNDICE DE CATEGORIAS DA VITRINE
+# Pré-calcula, junto com o cache da loja, a lista de produtos de cada categoria para a página de
+# categoria custar O(resultado). Produtos sem categoria entram em todas as listas na mesma posição
+# em que aparecem no catálogo, como no filtro original.
+def _agrupar_por_categoria(itens, ids_categoria):
+    grupos = {cid: [] for cid in ids_categoria}
+    sem_categoria = []
+    for p in itens:
+        if not p.get('categoria_id'):
+            sem_categoria.append(p)
+            for lista in grupos.values():
+                lista.append(p)
+        else:
+            grupos[str(p['categoria_id'])].append(p)
+    return grupos, sem_categoria
+
+def indexar_categorias(categorias, produtos, novidades):
+    ids_categoria = {str(c.get('id')) for c in categorias}
+    ids_categoria |= {str(p['categoria_id']) for p in produtos if p.get('categoria_id')}
+    produtos_por_categoria, produtos_sem_categoria = _agrupar_por_categoria(produtos, ids_categoria)
+    novidades_por_categoria, novidades_sem_categoria = _agrupar_por_categoria(novidades, ids_categoria)
+    return {
+        "categorias_por_id": {str(c.get('id')): c for c in categorias},
+        "produtos_por_categoria": produtos_por_categoria,
+        "produtos_sem_categoria": produtos_sem_categoria,
+        "novidades_por_categoria": novidades_por_categoria,
+        "novidades_sem_categoria": novidades_sem_categoria
+    }
+
+# BUSCA LOCAL DE PRODUTOS
+# Índice invertido por loja, em memória no worker, sobre nome e descrição dos produtos.
+# Os termos usam a mesma normalização do gerar_slug (sem acento, minúsculo), a consulta casa
+# por prefixo e o resultado é ordenado por relevância (nome pesa mais que descrição).
+# O índice acompanha o cache da vitrine e só reindexa os produtos que mudaram.
+# Para o autocomplete, nomes de produtos e categorias ficam num vetor ordenado de chaves
+# (uma por palavra do nome), consultado por prefixo com bisect.
+BUSCA_MAX_LOJAS = int(os.getenv("BUSCA_MAX_LOJAS", 500)) # índices mantidos por worker
+SUGESTOES_MAX_CONSULTA = 64 # caracteres aceitos em ?q=
+SUGESTOES_MAX = 10 # itens por tipo na resposta
+SUGESTOES_VARREDURA = 200 # chaves examinadas por consulta, limita o custo de prefixos curtos
+PESO_NOME_EXATO, PESO_NOME_PREFIXO = 4.0, 2.0
+PESO_DESCRICAO_EXATO, PESO_DESCRICAO_PREFIXO = 1.0, 0.5
+
+def termos_busca(texto):
+    if not texto: return []
+    texto = re.sub(r'<[^>]+>', ' ', str(texto))
+    return [t for t in gerar_slug(texto).split('-') if t]
+
+class IndiceBusca:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.montado_em = None
+        self._docs = {} # id -> (assinatura, card, termos_nome, termos_descricao)
+        self._ordem = {} # id -> posição no catálogo (desempate)
+        self._postings = {} # termo -> {id: peso}
+        self._termos = [] # termos ordenados para casar prefixos com bisect
+        self._categorias = None # assinatura das categorias usadas nas sugestões
+        self._sugestoes = [] # (chave, tipo, id) ordenado por chave
+        self._itens = {} # (tipo, id) -> dados exibidos na sugestão
+
+    def _remover(self, pid):
+        _, _, termos_nome, termos_desc = self._docs.pop(pid)
+        for termo in termos_nome | termos_desc:
+            docs = self._postings.get(termo)
+            if docs is not None:
+                docs.pop(pid, None)
+                if not docs: del self._postings[termo]
+
+    def _adicionar(self, pid, assinatura, card):
+        termos_nome = set(termos_busca(card.get('nome')))
+        termos_desc = set(termos_busca(card.get('descricao')))
+        self._docs[pid] = (assinatura, card, termos_nome, termos_desc)
+        for termo in termos_desc:
+            self._postings.setdefault(termo, {})[pid] = PESO_DESCRICAO_EXATO
+        for termo in termos_nome:
+            self._postings.setdefault(termo, {})[pid] = PESO_NOME_EXATO
+
+    def sincronizar(self, dados):
+        # Atualização incremental: só produtos novos, removidos ou com nome/descrição alterados
+        produtos, montado_em = dados["produtos"], dados["montado_em"]
+        with self._lock:
+            if montado_em == self.montado_em:
+                return
+            mudou = False
+            ids_atuais = set()
+            for pos, card in enumerate(produtos):
+                pid = card['id']
+                ids_atuais.add(pid)
+                self._ordem[pid] = pos
+                assinatura = (card.get('nome'), card.get('descricao'))
+                doc = self._docs.get(pid)
+                if doc and doc[0] == assinatura:
+                    # Conteúdo igual, só troca o card para refletir preço/imagem atuais
+                    self._docs[pid] = (assinatura, card, doc[2], doc[3])
+                    continue
+                if doc: self._remover(pid)
+                self._adicionar(pid, assinatura, card)
+                mudou = True
+            for pid in [pid for pid in self._docs if pid not in ids_atuais]:
+                self._remover(pid)
+                self._ordem.pop(pid, None)
+                mudou = True
+            if mudou:
+                self._termos = sorted(self._postings)
+            categorias = tuple((c['id'], c.get('nome')) for c in dados["categorias"])
+            if mudou or categorias != self._categorias:
+                self._montar_sugestoes(categorias)
+            self.montado_em = montado_em
+
+    def _montar_sugestoes(self, categorias):
+        self._categorias = categorias
+        itens, chaves = {}, []
+        for tipo, nomes in (("categoria", categorias),
+                            ("produto", ((pid, doc[1].get('nome')) for pid, doc in self._docs.items()))):
+            for item_id, nome in nomes:
+                termos = termos_busca(nome)
+                if not termos: continue
+                # Uma chave por palavra: "bolo-de-cenoura", "de-cenoura", "cenoura"
+                for i in range(len(termos)):
+                    chaves.append(('-'.join(termos[i:]), i, tipo, item_id))
+                itens[(tipo, item_id)] = nome
+        chaves.sort()
+        self._sugestoes = chaves
+        self._itens = itens
+
+    def sugerir(self, consulta, limite=SUGESTOES_MAX):
+        # Nomes que começam pela consulta vêm antes dos que só têm uma palavra começando por ela
+        prefixo = '-'.join(termos_busca(consulta[:SUGESTOES_MAX_CONSULTA]))
+        if not prefixo:
+            return [], []
+        with self._lock:
+            casados = []
+            i = bisect_left(self._sugestoes, (prefixo,))
+            fim = min(len(self._sugestoes), i + SUGESTOES_VARREDURA)
+            while i < fim and self._sugestoes[i][0].startswith(prefixo):
+                casados.append(self._sugestoes[i])
+                i += 1
+            casados.sort(key=lambda c: (c[1] > 0, self._ordem.get(c[3], 0) if c[2] == "produto" else 0, c[0]))
+            categorias, produtos, vistos = [], [], set()
+            for _, _, tipo, item_id in casados:
+                if (tipo, item_id) in vistos: continue
+                vistos.add((tipo, item_id))
+                if tipo == "categoria" and len(categorias) < limite:
+                    categorias.append({"id": item_id, "nome": self._itens[(tipo, item_id)]})
+                elif tipo == "produto" and len(produtos) < limite:
+                    produtos.append(self._docs[item_id][1])
+            return categorias, produtos
+
+    def _casar_termo(self, termo):
+        # {id: peso} para o termo exato e para os termos que começam com ele
+        pesos = {}
+        i = bisect_left(self._termos, termo)
+        while i < len(self._termos) and self._termos[i].startswith(termo):
+            exato = self._termos[i] == termo
+            for pid, peso in self._postings[self._termos[i]].items():
+                if not exato:
+                    peso = PESO_NOME_PREFIXO if peso == PESO_NOME_EXATO else PESO_DESCRICAO_PREFIXO
+                if peso > pesos.get(pid, 0):
+                    pesos[pid] = peso
+            i += 1
+        return pesos
+
+    def buscar(self, consulta, limite=None):
+        termos = termos_busca(consulta)
+        if not termos:
+            return []
+        with self._lock:
+            pontos = None
+            for termo in termos:
+                pesos = self._casar_termo(termo)
+                # Todos os termos da consulta precisam aparecer no produto
+                if pontos is None:
+                    pontos = pesos
+                else:
+                    pontos = {pid: pontos[pid] + peso for pid, peso in pesos.items() if pid in pontos}
+                if not pontos:
+                    return []
+            ordenados = sorted(pontos, key=lambda pid: (-pontos[pid], self._ordem.get(pid, 0)))
+            if limite:
+                ordenados = ordenados[:limite]
+            return [self._docs[pid][1] for pid in ordenados]
+
+_indices_busca = OrderedDict()
+_indices_busca_lock = threading.Lock()
+
+def indice_busca_loja(loja_id, dados):
+    # Índice da loja sincronizado com o cache da vitrine recebido
+    with _indices_busca_lock:
+        indice = _indices_busca.get(loja_id)
+        if indice is None:
+            indice = _indices_busca[loja_id] = IndiceBusca()
+            while len(_indices_busca) > BUSCA_MAX_LOJAS:
+                _indices_busca.popitem(last=False)
+        else:
+            _indices_busca.move_to_end(loja_id)
+    indice.sincronizar(dados)
+    return indice
+
+# PAGINAÇÃO DA VITRINE
+# Listas de produtos em cache já estão em ordem estável (sort, id). O cursor é a chave do último
+# item entregue e a página seguinte começa logo depois dela por busca binária, então o custo de
+# cada página não cresce com o catálogo.
+PRODUTOS_POR_PAGINA = int(os.getenv("PRODUTOS_POR_PAGINA", 24))
+PRODUTOS_POR_PAGINA_MAX = 60
+
+def codificar_cursor(chave):
+    return base64.urlsafe_b64encode(json.dumps(list(chave)).encode()).decode().rstrip('=')
+
+def decodificar_cursor(cursor):
+    # ValueError para cursor inválido
+    try:
+        chave = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("cursor inválido")
+    if not isinstance(chave, list) or len(chave) != 2:
+        raise ValueError("cursor inválido")
+    return tuple(chave)
+
+def paginar_produtos(produtos, cursor=None, limite=PRODUTOS_POR_PAGINA):
+    inicio = 0
+    if cursor:
+        chave = decodificar_cursor(cursor)
+        baixo, alto = 0, len(produtos)
+        try:
+            while baixo < alto:
+                meio = (baixo + alto) // 2
+                if tuple(produtos[meio]['ordem']) <= chave: baixo = meio + 1
+                else: alto = meio
+        except TypeError:
+            raise ValueError("cursor inválido")
+        inicio = baixo
+    itens = produtos[inicio:inicio + limite]
+    restantes = len(produtos) - inicio - len(itens)
+    return {
+        "itens": itens,
+        "proximo_cursor": codificar_cursor(itens[-1]['ordem']) if itens and restantes > 0 else None,
+        "total": len(produtos)
+    }
+
+# MONTAGEM DOS DADOS DA VITRINE
+# Não depende do contexto da requisição para poder rodar em reconstruções coalescidas e em segundo plano
+# FORMATO_VITRINE entra na chave do cache e muda sempre que a estrutura do dicionário muda
+FORMATO_VITRINE = 4
+VITRINE_TTL_FRESCO = int(os.getenv("VITRINE_TTL_FRESCO", 120))
+VITRINE_TTL_MAXIMO = int(os.getenv("VITRINE_TTL_MAXIMO", 86400))
+
+def montar_dados_index(loja_id):
+    # Categorias, produtos, posts e agenda em uma única requisição
+    # Versão lida antes da busca: uma edição no meio do caminho não fica gravada com a versão nova
+    versao_produtos = versao_item("produtos", loja_id)
+    versao_posts = versao_item("posts", loja_id)
+    dados = buscar_dados_vitrine(loja_id)
+    aquecer_itens_loja("produtos", loja_id, versao_produtos, dados.produtos)
+    aquecer_itens_loja("posts", loja_id, versao_posts, dados.posts)
+    categorias = dados.categorias
+    raw_prods  = dados.produtos
+    posts_raw  = dados.posts
+    agenda_raw = dados.agenda
+
+    produtos = []
+    novidades = []
+
+    try:
+        # Ordena pela posição e previne erros se o campo sort não existir no banco
+        def get_sort_val(p):
+            try:
+                return int(p.get('sort')) if p.get('sort') is not None else 999999
+            except:
+                return 999999
+
+        # Desempate pelo id deixa a ordem estável para a paginação por cursor
+        raw_prods.sort(key=lambda p: (get_sort_val(p), p['id']))
+
+        for p in raw_prods:
+            prod_obj = produto_view_model(p)["card"]
+            produtos.append(prod_obj)
+
+            if p.get('status_urgencia') in ['Alta Procura', 'Lancamento']:
+                novidades.append(prod_obj)
+
+    except Exception as e:
+        print(f"Erro produtos: {e}")
+
+    # Processa posts
+    posts = []
+    try:
+        for post in posts_raw:
+            posts.append({
+                "titulo": post['titulo'], "slug": post['slug'],
+                "resumo": post.get('resumo', ''),
+                "capa": get_img_url(post.get('capa')),
+                "data": datetime.fromisoformat(post['date_created'].split('T')[0]).strftime('%d/%m/%Y')
+            })
+    except: pass
+
+    # Processa agenda
+    agenda = []
+    try:
+        for item in agenda_raw:
+            try:
+                if item.get('data_hora'):
+                    dt = datetime.fromisoformat(item['data_hora'].replace('Z', '').replace(' ', 'T'))
+                    item['data_hora_formatada'] = dt.strftime('%d/%m/%Y às %H:%M')
+                else:
+                    item['data_hora_formatada'] = "Sem data"
+            except:
+                item['data_hora_formatada'] = item.get('data_hora')
+            agenda.append(item)
+    except: pass
+
+    return {
+        "categorias": categorias,
+        "produtos": produtos,
+        "novidades": novidades,
+        "posts": posts,
+        "agenda": agenda,
+        **indexar_categorias(categorias, produtos, novidades),
+        "montado_em": time.time()
+    }
+
 # ROTA INDEX A VITRINE DA LOJA
 # Atualizado removeu prefixo loja
+def carregar_vitrine(loja_id):
+    # CACHE: chave por loja e versão das coleções
+    # Stale-while-revalidate: depois de 2 minutos a versão anterior continua servida enquanto recarrega
+    cache_key = f"index_data_{FORMATO_VITRINE}_{loja_id}_{versao_loja(loja_id, COLECOES_VITRINE)}"
+    try:
+        return cache_swr(cache_key, lambda: montar_dados_index(loja_id),
+                         VITRINE_TTL_FRESCO, VITRINE_TTL_MAXIMO)
+    except Exception as e:
+        # Directus fora com o cache frio: a página sai vazia, mas não pode ser guardada em cache nenhum
+        print(f"Erro ao carregar vitrine: {e}")
+        marcar_degradada()
+        return {"categorias": [], "produtos": [], "novidades": [], "posts": [], "agenda": [],
+                **indexar_categorias([], [], []), "montado_em": 0, "degradado": True}
+
 @app.route('/<loja_slug>/')
 def index(loja_slug):
     if not g.loja: 
         return "Loja não encontrada", 404
 
-    headers = get_headers()
-
-    # 2 Parâmetros de busca/filtro (precisam ser lidos antes do cache)
+    # 2 Parâmetros de busca/filtro
     cat_filter = request.args.get('categoria')
     busca_query = request.args.get('busca')
 
-    # CACHE: chave por loja e busca apenas — cat_filter é aplicado depois, fora do cache
-    cache_key = f"index_data_{g.loja_id}_{busca_query or ''}"
-    cached = cache.get(cache_key)
-    if cached:
-        categorias = cached["categorias"]
-        produtos = cached["produtos"]
-        novidades = cached["novidades"]
-        posts = cached["posts"]
-        agenda = cached["agenda"]
-        # aplica filtro de categoria mesmo no cache
-        if cat_filter:
-            produtos = [p for p in produtos if str(p.get('categoria_id')) == str(cat_filter) or not p.get('categoria_id')]
-            novidades = [p for p in novidades if str(p.get('categoria_id')) == str(cat_filter) or not p.get('categoria_id')]
-    else:
-        # PARALELISMO: captura valores do contexto Flask ANTES de entrar nas threads
-        _loja_id = g.loja_id
-        _directus_url = DIRECTUS_URL
-        _headers = get_headers()
-        _busca_query = busca_query
-
-        def fetch_categorias():
-            url = f"{_directus_url}/items/categorias?filter[loja_id][_eq]={_loja_id}&filter[status][_eq]=published&sort=sort"
-            r = requests.get(url, headers=_headers, timeout=7)
-            return r.json()['data'] if r.status_code == 200 else []
-
-        def fetch_produtos():
-            url = f"{_directus_url}/items/produtos?filter[loja_id][_eq]={_loja_id}&filter[status][_eq]=published"
-            if _busca_query:
-                url += f"&filter[nome][_icontains]={_busca_query}"
-            url += "&fields=*.*"
-            r = requests.get(url, headers=_headers, timeout=7)
-            return r.json()['data'] if r.status_code == 200 else []
-
-        def fetch_posts():
-            url = f"{_directus_url}/items/posts?filter[loja_id][_eq]={_loja_id}&filter[status][_eq]=published&limit=6&sort=-date_created"
-            r = requests.get(url, headers=_headers, timeout=7)
-            return r.json()['data'] if r.status_code == 200 else []
-
-        def fetch_agenda():
-            url = f"{_directus_url}/items/agenda?filter[loja_id][_eq]={_loja_id}&sort=data_hora"
-            r = requests.get(url, headers=_headers, timeout=7)
-            return r.json()['data'] if r.status_code == 200 else []
-
-        with ThreadPoolExecutor(max_workers=4) as ex:
-            f_cat   = ex.submit(fetch_categorias)
-            f_prod  = ex.submit(fetch_produtos)
-            f_posts = ex.submit(fetch_posts)
-            f_ag    = ex.submit(fetch_agenda)
-            categorias = f_cat.result()
-            raw_prods  = f_prod.result()
-            posts_raw  = f_posts.result()
-            agenda_raw = f_ag.result()
-
-        produtos = []
-        novidades = []
-
-        try:
-            # Filtra categoria no Python para garantir que produtos sem categoria apareçam sempre
-            if cat_filter:
-                filtered_prods = []
-                for p in raw_prods:
-                    cv = p.get('categoria_id')
-                    if isinstance(cv, dict): cv = cv.get('id')
-                    if str(cv) == str(cat_filter) or not p.get('categoria_id'):
-                        filtered_prods.append(p)
-                raw_prods = filtered_prods
-
-            # Ordena pela posição e previne erros se o campo sort não existir no banco
-            def get_sort_val(p):
-                try:
-                    return int(p.get('sort')) if p.get('sort') is not None else 999999
-                except:
-                    return 999999
-
-            raw_prods.sort(key=get_sort_val)
-
-            for p in raw_prods:
-                img = get_img_url(p.get('imagem_destaque') or p.get('imagem1'))
-
-                # Repassamos as variantes cruas, sem processar fotos
-                variantes = p.get('variantes') or []
-
-                try: preco_float = float(p.get('preco', 0))
-                except: preco_float = 0.0
-
-                try: estoque_val = int(p.get('estoque')) if p.get('estoque') is not None else 0
-                except: estoque_val = 0
-
-                cat_val = p.get('categoria_id')
-                if isinstance(cat_val, dict): cat_val = cat_val.get('id')
-
-                prod_obj = {
-                    "id": p['id'], "nome": p['nome'], "slug": p['slug'],
-                    "preco": preco_float,
-                    "imagem": img,
-                    "imagem1": get_img_url(p.get('imagem1')),
-                    "imagem2": get_img_url(p.get('imagem2')),
-                    "imagem_secundaria": get_img_url(p.get('imagem_secundaria')),
-                    "imagem3": get_img_url(p.get('imagem3')),
-                    "imagem4": get_img_url(p.get('imagem4')),
-                    "imagem5": get_img_url(p.get('imagem5')),
-                    "categoria_id": cat_val,
-                    "variantes": variantes, "origem": p.get('origem'),
-                    "urgencia": p.get('status_urgencia'), "classe_frete": p.get('classe_frete'),
-                    "estoque": estoque_val, "consulte": p.get('consulte', False),
-                    "a_partir_de": p.get('a_partir_de', False),
-                    "layout_case": p.get('layout_case', False),
-                    "link_projeto": p.get('link_projeto'),
-                    "whatsapp_projeto": p.get('whatsapp_projeto'),
-                    "descricao": p.get('descricao')
-                }
-                produtos.append(prod_obj)
-
-                if p.get('status_urgencia') in ['Alta Procura', 'Lancamento']:
-                    novidades.append(prod_obj)
-
-        except Exception as e:
-            print(f"Erro produtos: {e}")
-
-        # Processa posts
-        posts = []
-        try:
-            for post in posts_raw:
-                posts.append({
-                    "titulo": post['titulo'], "slug": post['slug'],
-                    "resumo": post.get('resumo', ''),
-                    "capa": get_img_url(post.get('capa')),
-                    "data": datetime.fromisoformat(post['date_created'].split('T')[0]).strftime('%d/%m/%Y')
-                })
-        except: pass
-
-        # Processa agenda
-        agenda = []
-        try:
-            for item in agenda_raw:
-                try:
-                    if item.get('data_hora'):
-                        dt = datetime.fromisoformat(item['data_hora'].replace('Z', '').replace(' ', 'T'))
-                        item['data_hora_formatada'] = dt.strftime('%d/%m/%Y às %H:%M')
-                    else:
-                        item['data_hora_formatada'] = "Sem data"
-                except:
-                    item['data_hora_formatada'] = item.get('data_hora')
-                agenda.append(item)
-        except: pass
-
-        # Salva no cache por 2 minutos
-        cache.set(cache_key, {
-            "categorias": categorias,
-            "produtos": produtos,
-            "novidades": novidades,
-            "posts": posts,
-            "agenda": agenda
-        }, timeout=120)
-
-    # Recupera o objeto da categoria selecionada (para passar o nome e dados dela pro HTML)
+    # Categoria e busca são aplicadas sobre os dados da vitrine em cache
+    dados = carregar_vitrine(g.loja_id)
+    marcar_surrogate(*chaves_surrogate(g.loja_id, COLECOES_VITRINE))
+    categorias = dados["categorias"]
+    produtos = dados["produtos"]
+    novidades = dados["novidades"]
+    posts = dados["posts"]
+    agenda = dados["agenda"]
+
+    # aplica filtro de categoria pelo índice pré-calculado no cache
+    # Categoria desconhecida mostra só os produtos sem categoria, como o filtro linear fazia
     cat_obj = None
     if cat_filter:
-        for c in categorias:
-            if str(c.get('id')) == str(cat_filter):
-                cat_obj = c
-                break
+        produtos = dados["produtos_por_categoria"].get(str(cat_filter), dados["produtos_sem_categoria"])
+        novidades = dados["novidades_por_categoria"].get(str(cat_filter), dados["novidades_sem_categoria"])
+        # Objeto da categoria selecionada (para passar o nome e dados dela pro HTML)
+        cat_obj = dados["categorias_por_id"].get(str(cat_filter))
+
+    # Busca local no índice invertido da loja, ordenada por relevância
+    if busca_query:
+        encontrados = indice_busca_loja(g.loja_id, dados).buscar(busca_query)
+        ids_visiveis = {p['id'] for p in produtos}
+        produtos = [p for p in encontrados if p['id'] in ids_visiveis]
+        ids_encontrados = {p['id'] for p in encontrados}
+        novidades = [p for p in novidades if p['id'] in ids_encontrados]
+
+    # Primeira página da seção de produtos; o restante vem de /api/produtos conforme rola
+    # Resultado de busca é ordenado por relevância e vai inteiro
+    paginacao = None if busca_query else paginar_produtos(produtos)
+    produtos_pagina = paginacao["itens"] if paginacao else produtos
 
     loja_visual = {
         **g.loja,
@@ -616,6 +2104,8 @@ def index(loja_slug):
                          layout=g.layout_list,
                          categorias=categorias, 
                          produtos=produtos, 
+                         produtos_pagina=produtos_pagina,
+                         paginacao=paginacao,
                          novidades=novidades, 
                          posts=posts,
                          agenda=agenda,
@@ -623,51 +2113,83 @@ def index(loja_slug):
                          directus_url=DIRECTUS_URL)
 
 
+# LISTAGEM PAGINADA DE PRODUTOS (scroll infinito dos temas)
+# Temas de catálogo com carrossel paginado e o componente de card de cada um. Os demais temas são
+# vitrines institucionais (serviços, cases, votação) que agrupam, ordenam ou numeram a lista inteira
+# no próprio template e continuam recebendo `produtos` completo.
+CARDS_PRODUTO_TEMA = {
+    'index': 'components/card_produto.html',
+    'direto': 'components/card_produto_direto.html',
+    'direto_index': 'components/card_produto_direto_index.html',
+}
+
+@app.route('/<loja_slug>/api/produtos')
+def api_produtos(loja_slug):
+    if not g.loja:
+        return jsonify({"erro": "Loja não encontrada"}), 404
+
+    try: limite = max(1, min(int(request.args.get('limite', PRODUTOS_POR_PAGINA)), PRODUTOS_POR_PAGINA_MAX))
+    except ValueError: limite = PRODUTOS_POR_PAGINA
+
+    dados = carregar_vitrine(g.loja_id)
+    cat_filter = request.args.get('categoria')
+    produtos = dados["produtos"]
+    if cat_filter:
+        produtos = dados["produtos_por_categoria"].get(str(cat_filter), dados["produtos_sem_categoria"])
+
+    try:
+        pagina = paginar_produtos(produtos, request.args.get('cursor'), limite)
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+
+    resposta = {
+        # Descrição e variantes ficam de fora, a listagem não usa
+        "produtos": [{k: v for k, v in p.items() if k not in ('ordem', 'descricao', 'variantes')} for p in pagina["itens"]],
+        "proximo_cursor": pagina["proximo_cursor"],
+        "total": pagina["total"]
+    }
+    if request.args.get('formato') == 'html':
+        # Cards já renderizados com o mesmo componente da primeira página
+        loja_visual = {**g.loja, "slug_url": loja_slug}
+        card = CARDS_PRODUTO_TEMA.get(g.loja.get('template_ativo'), CARDS_PRODUTO_TEMA['index'])
+        resposta["html"] = "".join(render_template(card, p=p, loja=loja_visual) for p in pagina["itens"])
+    return jsonify(resposta)
+
+# AUTOCOMPLETE DA BUSCA
+# Resposta pequena e sem render de template, servida do índice local da loja
+@app.route('/<loja_slug>/api/sugestoes')
+def api_sugestoes(loja_slug):
+    if not g.loja:
+        return jsonify({"erro": "Loja não encontrada"}), 404
+
+    consulta = (request.args.get('q') or '')[:SUGESTOES_MAX_CONSULTA]
+    try: limite = max(1, min(int(request.args.get('limite', SUGESTOES_MAX)), SUGESTOES_MAX))
+    except ValueError: limite = SUGESTOES_MAX
+
+    categorias, produtos = indice_busca_loja(g.loja_id, carregar_vitrine(g.loja_id)).sugerir(consulta, limite)
+    resposta = jsonify({
+        "q": consulta,
+        "categorias": [{"nome": c["nome"], "url": f"/{loja_slug}/?categoria={c['id']}"} for c in categorias],
+        "produtos": [{
+            "nome": p["nome"], "url": f"/{loja_slug}/produto/{p['slug']}",
+            "imagem": p["imagem"], "preco": p["preco"],
+            "consulte": p["consulte"], "a_partir_de": p["a_partir_de"]
+        } for p in produtos]
+    })
+    resposta.headers['Cache-Control'] = 'public, max-age=60'
+    return resposta
+
 # ROTA DETALHE DO PRODUTO
 # Atualizado removeu prefixo loja
 @app.route('/<loja_slug>/produto/<slug>')
 def produto(loja_slug, slug):
     if not g.loja: return "Loja não encontrada", 404
 
-    headers = get_headers()
-    url = f"{DIRECTUS_URL}/items/produtos?filter[slug][_eq]={slug}&filter[loja_id][_eq]={g.loja_id}&fields=*.*"
-    r = requests.get(url, headers=headers, timeout=7)
-    
-    if r.status_code == 200 and r.json()['data']:
-        p = r.json()['data'][0]
-        
-        cv = p.get('categoria_id')
-        if isinstance(cv, dict): p['categoria_id'] = cv.get('id')
-        
-        p['imagem_destaque'] = get_img_url(p.get('imagem_destaque'))
-        p['imagem1'] = get_img_url(p.get('imagem1'))
-        p['imagem2'] = get_img_url(p.get('imagem2'))
-        p['imagem3'] = get_img_url(p.get('imagem3'))
-        p['imagem4'] = get_img_url(p.get('imagem4'))
-        p['imagem5'] = get_img_url(p.get('imagem5'))
-        
-        galeria = []
-        if p.get('imagem_destaque'): galeria.append(p['imagem_destaque'])
-        if p.get('imagem1'): galeria.append(p['imagem1'])
-        if p.get('imagem2'): galeria.append(p['imagem2'])
-        
-        if not galeria:
-            galeria = ["https://placehold.co/600x600?text=Sem+Imagem"]
-            
-        p['galeria'] = galeria
-
-        # Variantes agora usam formato de grupos, não buscamos imagem individual mais
-        if p.get('variantes'):
-            pass 
+    raw = produto_da_loja(g.loja_id, slug=slug)
 
-        try: p['preco'] = float(p.get('preco', 0))
-        except: p['preco'] = 0.0
-            
-        try: p['estoque'] = int(p.get('estoque')) if p.get('estoque') is not None else 0
-        except: p['estoque'] = 0
-
-        p['a_partir_de'] = p.get('a_partir_de', False)
-        p['layout_case'] = p.get('layout_case', False)
+    if raw:
+        p = produto_view_model(raw)["detalhe"]
+        marcar_surrogate(*chaves_surrogate(g.loja_id, ('produtos', 'categorias')), f"produto-{p['id']}")
 
         loja_visual = {
             **g.loja,
@@ -692,24 +2214,25 @@ def produto(loja_slug, slug):
 
         return render_template(template_produto, p=p, loja=loja_visual, directus_url=DIRECTUS_URL)
 
+    return "Produto não encontrado nesta loja", 404
+
 # ROTA PARA O CARTAZ INDIVIDUAL DO PERSONAGEM (WANTED)
 @app.route('/<loja_slug>/personagem/<slug>')
 def personagem_wanted(loja_slug, slug):
     if not g.loja: return "Loja não encontrada", 404
-    headers = get_headers()
     # Busca o personagem específico
-    url = f"{DIRECTUS_URL}/items/produtos?filter[slug][_eq]={slug}&filter[loja_id][_eq]={g.loja_id}&fields=*.*"
-    r = requests.get(url, headers=headers, timeout=7)
-    
-    if r.status_code == 200 and r.json()['data']:
-        p = r.json()['data'][0]
-        
-        # TRATAMENTO DE SEGURANÇA PARA NÃO DAR ERRO 500
-        try: p['preco'] = float(p.get('preco', 0))
-        except: p['preco'] = 0.0
-        
-        p['imagem_destaque'] = get_img_url(p.get('imagem_destaque') or p.get('imagem1'))
-        p['descricao'] = p.get('descricao', 'Sem descrição disponível.')
+    raw = produto_da_loja(g.loja_id, slug=slug)
+
+    if raw:
+        detalhe = produto_view_model(raw)["detalhe"]
+        marcar_surrogate(*chaves_surrogate(g.loja_id, ('produtos', 'categorias')), f"produto-{detalhe['id']}")
+
+        # Cartaz usa a imagem 1 quando não há destaque
+        p = {
+            **detalhe,
+            "imagem_destaque": detalhe['imagem_destaque'] or detalhe['imagem1'],
+            "descricao": detalhe.get('descricao', 'Sem descrição disponível.')
+        }
 
         loja_visual = {
             **g.loja, 
@@ -719,44 +2242,18 @@ def personagem_wanted(loja_slug, slug):
         return render_template('personagensone.html', p=p, loja=loja_visual)
     
     return "Pirata não encontrado", 404
-    
-    return "Produto não encontrado nesta loja", 404
 
 
 @app.route('/<loja_slug>/case/<produto_id>')
 def case_page(loja_slug, produto_id):
     if not g.loja: return "Loja não encontrada", 404
 
-    headers = get_headers()
-    
     # Busca o projeto/produto específico
-    url = f"{DIRECTUS_URL}/items/produtos?filter[id][_eq]={produto_id}&filter[loja_id][_eq]={g.loja_id}&fields=*.*"
-    r = requests.get(url, headers=headers, timeout=7)
-    
-    if r.status_code == 200 and r.json()['data']:
-        p = r.json()['data'][0]
-        
-        p['imagem_destaque'] = get_img_url(p.get('imagem_destaque'))
-        p['imagem1'] = get_img_url(p.get('imagem1'))
-        p['imagem2'] = get_img_url(p.get('imagem2'))
-        p['imagem3'] = get_img_url(p.get('imagem3'))
-        p['imagem4'] = get_img_url(p.get('imagem4'))
-        p['imagem5'] = get_img_url(p.get('imagem5'))
-        
-        # Tratamento de galeria exigido em algumas partes do seu layout
-        galeria = []
-        if p.get('imagem_destaque'): galeria.append(p['imagem_destaque'])
-        if p.get('imagem1'): galeria.append(p['imagem1'])
-        if p.get('imagem2'): galeria.append(p['imagem2'])
-        if not galeria:
-            galeria = ["https://placehold.co/600x600?text=Sem+Imagem"]
-        p['galeria'] = galeria
-
-        try: p['preco'] = float(p.get('preco', 0))
-        except: p['preco'] = 0.0
-            
-        try: p['estoque'] = int(p.get('estoque')) if p.get('estoque') is not None else 0
-        except: p['estoque'] = 0
+    raw = produto_da_loja(g.loja_id, produto_id=produto_id)
+
+    if raw:
+        p = produto_view_model(raw)["detalhe"]
+        marcar_surrogate(*chaves_surrogate(g.loja_id, ('produtos', 'categorias')), f"produto-{p['id']}")
 
         loja_visual = {
             **g.loja,
@@ -803,6 +2300,82 @@ def admin_login(loja_slug):
     return render_template('login_admin.html', loja=loja_visual)
 
 
+# ABAS DO PAINEL
+# O painel abre só com a casca (dados da loja e categorias) e cada aba busca a própria listagem
+# paginada em /admin/api/<aba> quando é aberta, em vez de carregar as cinco coleções inteiras no GET.
+PAINEL_POR_PAGINA = 50
+PAINEL_POR_PAGINA_MAX = 100
+CAMPOS_INSCRITO_ADMIN = ["id", "nome", "whatsapp", "email", "date_created"]
+
+# aba -> (coleção, campos, ordenação, campos pesquisados pelo filtro de texto)
+ABAS_PAINEL = {
+    "produtos": ("produtos", CAMPOS_PRODUTO_ADMIN, ["sort", "id"], ("nome",)),
+    "blog": ("posts", CAMPOS_POST_ADMIN, ["-date_created", "-id"], ("titulo",)),
+    "inscritos": ("clientes_loja", CAMPOS_INSCRITO_ADMIN, ["-date_created", "-id"], ("nome", "email", "whatsapp")),
+    "agenda": ("agenda", None, ["data_hora", "id"], ("cliente_nome",)),
+}
+
+def _tratar_produto_admin(p):
+    p['imagem_destaque'] = get_img_url(p.get('imagem_destaque'))
+    try: p['preco'] = float(p['preco']) if p.get('preco') else 0.0
+    except: p['preco'] = 0.0
+
+    # Tratamento: Se a categoria vier como objeto do Directus, extrai o ID
+    cv = p.get('categoria_id')
+    if isinstance(cv, dict): p['categoria_id'] = cv.get('id')
+    return p
+
+def _tratar_agenda_admin(item):
+    try:
+        if item.get('data_hora'):
+            dt = datetime.fromisoformat(item['data_hora'].replace('Z', '').replace(' ', 'T'))
+            item['data_hora_formatada'] = dt.strftime('%d/%m/%Y às %H:%M')
+        else:
+            item['data_hora_formatada'] = "Sem data"
+    except:
+        item['data_hora_formatada'] = item.get('data_hora')
+    return item
+
+TRATAMENTO_ABAS = {"produtos": _tratar_produto_admin, "agenda": _tratar_agenda_admin}
+
+@app.route('/<loja_slug>/admin/api/<aba>')
+def admin_api_aba(loja_slug, aba):
+    if not g.loja or session.get('loja_admin_id') != g.loja_id:
+        return jsonify({"erro": "Não autorizado"}), 401
+    if aba not in ABAS_PAINEL:
+        return jsonify({"erro": "Aba inexistente"}), 404
+
+    colecao, campos, ordem, pesquisaveis = ABAS_PAINEL[aba]
+    try:
+        pagina = max(1, int(request.args.get('pagina', 1)))
+        limite = max(1, min(int(request.args.get('limite', PAINEL_POR_PAGINA)), PAINEL_POR_PAGINA_MAX))
+    except ValueError:
+        return jsonify({"erro": "Parâmetros de paginação inválidos"}), 400
+
+    filtro = {"loja_id": {"_eq": g.loja_id}}
+    termo = (request.args.get('q') or '').strip()[:100]
+    if termo:
+        filtro["_or"] = [{campo: {"_icontains": termo}} for campo in pesquisaveis]
+    if aba == "produtos" and request.args.get('categoria'):
+        filtro["categoria_id"] = {"_eq": request.args.get('categoria')}
+
+    try:
+        itens, total = buscar_pagina(Consulta(colecao, filtro, sort=ordem, limit=limite, campos=campos), pagina)
+    except Exception as e:
+        print(f"Erro ao carregar aba {aba} do painel: {e}")
+        return jsonify({"erro": "Falha ao carregar dados"}), 502
+
+    tratar = TRATAMENTO_ABAS.get(aba)
+    if tratar: itens = [tratar(i) for i in itens]
+    resposta = jsonify({
+        "itens": itens,
+        "total": total,
+        "pagina": pagina,
+        "paginas": max(1, -(-total // limite))
+    })
+    resposta.headers['Cache-Control'] = 'private, no-store'
+    return resposta
+
 # ROTA PAINEL DE EDIÇÃO
 # Atualizado removeu prefixo loja
 @app.route('/<loja_slug>/admin/painel', methods=['GET', 'POST'])
@@ -812,15 +2385,9 @@ def admin_painel(loja_slug):
     if session.get('loja_admin_id') != g.loja_id:
         return redirect(f'/{loja_slug}/admin')
 
-    headers = get_headers()
-
     if request.method == 'POST':
-        files_map = {}
-        for key in ['logo', 'bannerprincipal1', 'bannerprincipal2', 'bannermenor1', 'bannermenor2', 'sobre_imagem']:
-            f = request.files.get(key)
-            if f and f.filename:
-                fid = upload_file_to_directus(f)
-                if fid: files_map[key] = fid
+        files_map, falhas = enviar_arquivos(['logo', 'bannerprincipal1', 'bannerprincipal2', 'bannermenor1', 'bannermenor2', 'sobre_imagem'])
+        avisar_uploads(files_map, falhas)
 
         payload = {
             "nome": request.form.get('nome'),
@@ -890,14 +2457,20 @@ def admin_painel(loja_slug):
         payload.update(files_map)
 
         try:
-            requests.patch(f"{DIRECTUS_URL}/items/lojas/{g.loja_id}", headers=headers, json=payload, timeout=7)
+            directus.patch(f"{DIRECTUS_URL}/items/lojas/{g.loja_id}", json=payload, timeout=7)
             flash('Loja atualizada com sucesso!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'lojas')
         except Exception as e:
             flash(f'Erro ao salvar: {e}', 'error')
         
         return redirect(f'/{loja_slug}/admin/painel')
 
+    template_painel = 'painel.html'
+    if loja_slug == 'creapes':
+        template_painel = 'painel_creapes.html'
+    elif loja_slug == 'variasfita':
+        template_painel = 'painel_creapes.html'
+
     categorias = []
     produtos = []
     posts = []
@@ -905,52 +2478,31 @@ def admin_painel(loja_slug):
     agenda = []
 
     try:
-        r_cat = requests.get(f"{DIRECTUS_URL}/items/categorias?filter[loja_id][_eq]={g.loja_id}&sort=sort", headers=headers, timeout=7)
-        if r_cat.status_code == 200: categorias = r_cat.json()['data']
+        if template_painel == 'painel.html':
+            # Só a casca: as listagens das abas vêm de /admin/api/<aba> sob demanda
+            categorias = buscar_colecoes({
+                "categorias": Consulta("categorias", {"loja_id": {"_eq": g.loja_id}}, sort=["sort"]),
+            })["categorias"]
+        else:
+            # O painel antigo ainda renderiza tudo no servidor: as cinco coleções em uma única requisição
+            dados = buscar_dados_painel(g.loja_id)
+            categorias = dados.categorias
+            posts = dados.posts
+            inscritos = dados.inscritos
+
+            raw_prods = dados.produtos
 
-        r_prod = requests.get(f"{DIRECTUS_URL}/items/produtos?filter[loja_id][_eq]={g.loja_id}&limit=100&fields=*.*", headers=headers, timeout=7)
-        if r_prod.status_code == 200: 
-            raw_prods = r_prod.json()['data']
-            
             # Ordena pela posição no Python e previne erros se o campo sort não existir no banco
             def get_sort_val(p):
                 try:
                     return int(p.get('sort')) if p.get('sort') is not None else 999999
                 except:
                     return 999999
-            
-            raw_prods.sort(key=get_sort_val)
-            
-            for p in raw_prods:
-                p['imagem_destaque'] = get_img_url(p.get('imagem_destaque'))
-                try: p['preco'] = float(p['preco']) if p.get('preco') else 0.0
-                except: p['preco'] = 0.0
-                
-                # Tratamento: Se a categoria vier como objeto do Directus, extrai o ID
-                cv = p.get('categoria_id')
-                if isinstance(cv, dict): p['categoria_id'] = cv.get('id')
-                
-                produtos.append(p)
 
-        r_post = requests.get(f"{DIRECTUS_URL}/items/posts?filter[loja_id][_eq]={g.loja_id}&limit=20&sort=-date_created&fields=id,titulo,resumo,conteudo,date_created", headers=headers, timeout=7)
-        if r_post.status_code == 200: posts = r_post.json()['data']
-        
-        r_leads = requests.get(f"{DIRECTUS_URL}/items/clientes_loja?filter[loja_id][_eq]={g.loja_id}&sort=-date_created", headers=headers, timeout=7)
-        if r_leads.status_code == 200: inscritos = r_leads.json()['data']
+            raw_prods.sort(key=get_sort_val)
+            produtos = [_tratar_produto_admin(p) for p in raw_prods]
+            agenda = [_tratar_agenda_admin(item) for item in dados.agenda]
 
-        r_agenda = requests.get(f"{DIRECTUS_URL}/items/agenda?filter[loja_id][_eq]={g.loja_id}&sort=data_hora", headers=headers, timeout=7)
-        if r_agenda.status_code == 200:
-            for item in r_agenda.json()['data']:
-                try:
-                    if item.get('data_hora'):
-                        dt = datetime.fromisoformat(item['data_hora'].replace('Z', '').replace(' ', 'T'))
-                        item['data_hora_formatada'] = dt.strftime('%d/%m/%Y às %H:%M')
-                    else:
-                        item['data_hora_formatada'] = "Sem data"
-                except:
-                    item['data_hora_formatada'] = item.get('data_hora')
-                agenda.append(item)
-        
     except Exception as e:
         print(f"Erro ao carregar dados do painel: {e}")
 
@@ -978,12 +2530,6 @@ def admin_painel(loja_slug):
         "slug_url": loja_slug
     }
 
-    template_painel = 'painel.html'
-    if loja_slug == 'creapes':
-        template_painel = 'painel_creapes.html'
-    elif loja_slug == 'variasfita':
-        template_painel = 'painel_creapes.html'
-
     return render_template(template_painel, 
                            loja=loja_visual, 
                            categorias=categorias, 
@@ -1005,7 +2551,6 @@ def admin_salvar_categoria(loja_slug):
         flash('Nome da categoria é obrigatório', 'error')
         return redirect(f'/{loja_slug}/admin/painel#categorias')
 
-    headers = get_headers()
     payload = {
         "nome": nome,
         "slug": gerar_slug(nome),
@@ -1016,18 +2561,18 @@ def admin_salvar_categoria(loja_slug):
     try:
         if cat_id:
             # PROTEÇÃO IDOR
-            check = requests.get(f"{DIRECTUS_URL}/items/categorias/{cat_id}?fields=loja_id", headers=headers, timeout=7)
+            check = directus.get(f"{DIRECTUS_URL}/items/categorias/{cat_id}?fields=loja_id", timeout=7)
             if check.status_code != 200 or check.json().get('data', {}).get('loja_id') != g.loja_id:
                 flash('Acesso negado. Tentativa de alteração inválida.', 'error')
                 return redirect(f'/{loja_slug}/admin/painel#categorias')
                 
-            requests.patch(f"{DIRECTUS_URL}/items/categorias/{cat_id}", headers=headers, json=payload, timeout=7)
+            directus.patch(f"{DIRECTUS_URL}/items/categorias/{cat_id}", json=payload, timeout=7)
             flash('Categoria atualizada!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'categorias')
         else:
-            requests.post(f"{DIRECTUS_URL}/items/categorias", headers=headers, json=payload, timeout=7)
+            directus.post(f"{DIRECTUS_URL}/items/categorias", json=payload, timeout=7)
             flash('Categoria criada!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'categorias')
     except Exception as e:
         flash(f'Erro ao salvar categoria: {e}', 'error')
 
@@ -1040,13 +2585,12 @@ def admin_excluir_categoria(loja_slug, id):
     if session.get('loja_admin_id') != g.loja_id: return redirect('/')
     
     # PROTEÇÃO IDOR INÍCIO
-    headers = get_headers()
-    check = requests.get(f"{DIRECTUS_URL}/items/categorias/{id}?fields=loja_id", headers=headers, timeout=7)
+    check = directus.get(f"{DIRECTUS_URL}/items/categorias/{id}?fields=loja_id", timeout=7)
     
     if check.status_code == 200 and check.json().get('data', {}).get('loja_id') == g.loja_id:
-        requests.delete(f"{DIRECTUS_URL}/items/categorias/{id}", headers=headers, timeout=7)
+        directus.delete(f"{DIRECTUS_URL}/items/categorias/{id}", timeout=7)
         flash('Categoria removida!', 'success')
-        cache.clear()
+        invalidar_loja(g.loja_id, 'categorias')
     else:
         flash('Acesso negado ou item não encontrado.', 'error')
     # PROTEÇÃO IDOR FIM
@@ -1122,58 +2666,27 @@ def admin_salvar_produto(loja_slug):
     if not prod_id and nome:
         payload["slug"] = gerar_slug(nome)
 
-    # Upload da Imagem Principal Destaque
-    f = request.files.get('imagem')
-    if f and f.filename:
-        fid = upload_file_to_directus(f)
-        if fid: payload['imagem_destaque'] = fid
-
-    # Upload da Imagem 1
-    f1 = request.files.get('imagem1')
-    if f1 and f1.filename:
-        fid1 = upload_file_to_directus(f1)
-        if fid1: payload['imagem1'] = fid1
-
-    # Upload da Imagem 2
-    f2 = request.files.get('imagem2')
-    if f2 and f2.filename:
-        fid2 = upload_file_to_directus(f2)
-        if fid2: payload['imagem2'] = fid2
-
-    # Upload da Imagem 3
-    f3 = request.files.get('imagem3')
-    if f3 and f3.filename:
-        fid3 = upload_file_to_directus(f3)
-        if fid3: payload['imagem3'] = fid3
-
-    # Upload da Imagem 4
-    f4 = request.files.get('imagem4')
-    if f4 and f4.filename:
-        fid4 = upload_file_to_directus(f4)
-        if fid4: payload['imagem4'] = fid4
-
-    # Upload da Imagem 5
-    f5 = request.files.get('imagem5')
-    if f5 and f5.filename:
-        fid5 = upload_file_to_directus(f5)
-        if fid5: payload['imagem5'] = fid5
-
-    headers = get_headers()
+    # Imagem de destaque e galeria sobem juntas
+    enviados, falhas = enviar_arquivos(['imagem', 'imagem1', 'imagem2', 'imagem3', 'imagem4', 'imagem5'])
+    avisar_uploads(enviados, falhas)
+    if 'imagem' in enviados: payload['imagem_destaque'] = enviados.pop('imagem')
+    payload.update(enviados)
+
     try:
         if prod_id:
             # PROTEÇÃO IDOR
-            check = requests.get(f"{DIRECTUS_URL}/items/produtos/{prod_id}?fields=loja_id", headers=headers, timeout=7)
+            check = directus.get(f"{DIRECTUS_URL}/items/produtos/{prod_id}?fields=loja_id", timeout=7)
             if check.status_code != 200 or check.json().get('data', {}).get('loja_id') != g.loja_id:
                 flash('Acesso negado. Tentativa de alteração inválida.', 'error')
                 return redirect(f'/{loja_slug}/admin/painel#produtos')
                 
-            requests.patch(f"{DIRECTUS_URL}/items/produtos/{prod_id}", headers=headers, json=payload, timeout=7)
+            directus.patch(f"{DIRECTUS_URL}/items/produtos/{prod_id}", json=payload, timeout=7)
             flash('Produto atualizado!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'produtos')
         else:
-            requests.post(f"{DIRECTUS_URL}/items/produtos", headers=headers, json=payload, timeout=7)
+            directus.post(f"{DIRECTUS_URL}/items/produtos", json=payload, timeout=7)
             flash('Produto criado!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'produtos')
     except Exception as e:
         flash(f'Erro interno ao salvar produto: {e}', 'error')
         
@@ -1187,13 +2700,12 @@ def admin_excluir_produto(loja_slug, id):
     if session.get('loja_admin_id') != g.loja_id: return redirect('/')
     
     # PROTEÇÃO IDOR INÍCIO
-    headers = get_headers()
-    check = requests.get(f"{DIRECTUS_URL}/items/produtos/{id}?fields=loja_id", headers=headers, timeout=7)
+    check = directus.get(f"{DIRECTUS_URL}/items/produtos/{id}?fields=loja_id", timeout=7)
     
     if check.status_code == 200 and check.json().get('data', {}).get('loja_id') == g.loja_id:
-        requests.delete(f"{DIRECTUS_URL}/items/produtos/{id}", headers=headers, timeout=7)
+        directus.delete(f"{DIRECTUS_URL}/items/produtos/{id}", timeout=7)
         flash('Produto removido!', 'success')
-        cache.clear()
+        invalidar_loja(g.loja_id, 'produtos')
     else:
         flash('Acesso negado ou item não encontrado.', 'error')
     # PROTEÇÃO IDOR FIM
@@ -1226,22 +2738,21 @@ def admin_salvar_post(loja_slug):
         fid = upload_file_to_directus(f)
         if fid: payload['capa'] = fid
 
-    headers = get_headers()
     try:
         if post_id:
             # PROTEÇÃO IDOR
-            check = requests.get(f"{DIRECTUS_URL}/items/posts/{post_id}?fields=loja_id", headers=headers, timeout=7)
+            check = directus.get(f"{DIRECTUS_URL}/items/posts/{post_id}?fields=loja_id", timeout=7)
             if check.status_code != 200 or check.json().get('data', {}).get('loja_id') != g.loja_id:
                 flash('Acesso negado. Tentativa de alteração inválida.', 'error')
                 return redirect(f'/{loja_slug}/admin/painel#blog')
                 
-            requests.patch(f"{DIRECTUS_URL}/items/posts/{post_id}", headers=headers, json=payload, timeout=7)
+            directus.patch(f"{DIRECTUS_URL}/items/posts/{post_id}", json=payload, timeout=7)
             flash('Post atualizado!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'posts')
         else:
-            requests.post(f"{DIRECTUS_URL}/items/posts", headers=headers, json=payload, timeout=7)
+            directus.post(f"{DIRECTUS_URL}/items/posts", json=payload, timeout=7)
             flash('Post criado!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'posts')
     except Exception as e:
         flash(f'Erro ao salvar post: {e}', 'error')
 
@@ -1254,13 +2765,12 @@ def admin_excluir_post(loja_slug, id):
     if session.get('loja_admin_id') != g.loja_id: return redirect('/')
     
     # PROTEÇÃO IDOR INÍCIO
-    headers = get_headers()
-    check = requests.get(f"{DIRECTUS_URL}/items/posts/{id}?fields=loja_id", headers=headers, timeout=7)
+    check = directus.get(f"{DIRECTUS_URL}/items/posts/{id}?fields=loja_id", timeout=7)
     
     if check.status_code == 200 and check.json().get('data', {}).get('loja_id') == g.loja_id:
-        requests.delete(f"{DIRECTUS_URL}/items/posts/{id}", headers=headers, timeout=7)
+        directus.delete(f"{DIRECTUS_URL}/items/posts/{id}", timeout=7)
         flash('Post removido!', 'success')
-        cache.clear()
+        invalidar_loja(g.loja_id, 'posts')
     else:
         flash('Acesso negado ou item não encontrado.', 'error')
     # PROTEÇÃO IDOR FIM
@@ -1273,24 +2783,19 @@ def blog_post(loja_slug, slug):
     if not g.loja:
         return "Loja não encontrada", 404
 
-    headers = get_headers()
-    url = f"{DIRECTUS_URL}/items/posts?filter[slug][_eq]={slug}&filter[loja_id][_eq]={g.loja_id}&fields=*.*"
-    r = requests.get(url, headers=headers, timeout=7)
+    post_raw = post_da_loja(g.loja_id, slug)
 
-    if r.status_code == 200 and r.json()['data']:
-        post_raw = r.json()['data'][0]
+    if post_raw:
+        marcar_surrogate(*chaves_surrogate(g.loja_id, ('posts', 'categorias')), f"post-{post_raw.get('id')}")
 
+        # O perfil do post já traz o nome da categoria; se vier só o id (REST com fields=*),
+        # a categoria sai do cache de itens da loja, sem montar a vitrine inteira
         categoria_nome = ""
-        try:
-            cat = post_raw.get('categoria_id')
-            if isinstance(cat, dict):
-                categoria_nome = cat.get('nome', '')
-            elif cat:
-                r_cat = requests.get(f"{DIRECTUS_URL}/items/categorias/{cat}?fields=nome", headers=headers, timeout=7)
-                if r_cat.status_code == 200:
-                    categoria_nome = r_cat.json().get('data', {}).get('nome', '')
-        except:
-            pass
+        cat = post_raw.get('categoria_id')
+        if isinstance(cat, dict):
+            categoria_nome = cat.get('nome') or ''
+        elif cat:
+            categoria_nome = (item_da_loja("categorias", g.loja_id, 'id', cat) or {}).get('nome') or ''
 
         try:
             data_pub = datetime.fromisoformat(post_raw['date_created'].split('T')[0]).strftime('%d/%m/%Y')
@@ -1340,22 +2845,21 @@ def admin_salvar_agenda(loja_slug):
         "cliente_nome": cliente_nome
     }
 
-    headers = get_headers()
     try:
         if agenda_id:
             # PROTEÇÃO IDOR
-            check = requests.get(f"{DIRECTUS_URL}/items/agenda/{agenda_id}?fields=loja_id", headers=headers, timeout=7)
+            check = directus.get(f"{DIRECTUS_URL}/items/agenda/{agenda_id}?fields=loja_id", timeout=7)
             if check.status_code != 200 or check.json().get('data', {}).get('loja_id') != g.loja_id:
                 flash('Acesso negado.', 'error')
                 return redirect(f'/{loja_slug}/admin/painel#agenda')
                 
-            requests.patch(f"{DIRECTUS_URL}/items/agenda/{agenda_id}", headers=headers, json=payload, timeout=7)
+            directus.patch(f"{DIRECTUS_URL}/items/agenda/{agenda_id}", json=payload, timeout=7)
             flash('Horário atualizado!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'agenda')
         else:
-            requests.post(f"{DIRECTUS_URL}/items/agenda", headers=headers, json=payload, timeout=7)
+            directus.post(f"{DIRECTUS_URL}/items/agenda", json=payload, timeout=7)
             flash('Horário criado!', 'success')
-            cache.clear()
+            invalidar_loja(g.loja_id, 'agenda')
     except Exception as e:
         flash(f'Erro ao salvar agenda: {e}', 'error')
 
@@ -1365,13 +2869,12 @@ def admin_salvar_agenda(loja_slug):
 def admin_excluir_agenda(loja_slug, id):
     if session.get('loja_admin_id') != g.loja_id: return redirect('/')
     
-    headers = get_headers()
-    check = requests.get(f"{DIRECTUS_URL}/items/agenda/{id}?fields=loja_id", headers=headers, timeout=7)
+    check = directus.get(f"{DIRECTUS_URL}/items/agenda/{id}?fields=loja_id", timeout=7)
     
     if check.status_code == 200 and check.json().get('data', {}).get('loja_id') == g.loja_id:
-        requests.delete(f"{DIRECTUS_URL}/items/agenda/{id}", headers=headers, timeout=7)
+        directus.delete(f"{DIRECTUS_URL}/items/agenda/{id}", timeout=7)
         flash('Horário removido!', 'success')
-        cache.clear()
+        invalidar_loja(g.loja_id, 'agenda')
     else:
         flash('Acesso negado.', 'error')
         
@@ -1390,7 +2893,7 @@ def esqueci_senha(loja_slug):
         
         # Busca o email direto do banco para evitar problema de cache desatualizado
         try:
-            r_email = requests.get(f"{DIRECTUS_URL}/items/lojas/{g.loja_id}?fields=email", headers=get_headers(), timeout=7)
+            r_email = directus.get(f"{DIRECTUS_URL}/items/lojas/{g.loja_id}?fields=email", timeout=7)
             email_cadastrado = r_email.json().get('data', {}).get('email', '') if r_email.status_code == 200 else g.loja.get('email', '')
         except:
             email_cadastrado = g.loja.get('email', '')
@@ -1421,7 +2924,7 @@ def reset_senha(token):
     error = None
     success = None
     
-    r = requests.get(f"{DIRECTUS_URL}/items/lojas?filter[email][_eq]={email}", headers=get_headers(), timeout=7)
+    r = directus.get(f"{DIRECTUS_URL}/items/lojas?filter[email][_eq]={email}", timeout=7)
     data = r.json().get('data')
     
     if not data: 
@@ -1433,10 +2936,9 @@ def reset_senha(token):
         new_password = request.form.get('password')
         if new_password:
             hash_senha = generate_password_hash(new_password)
-            requests.patch(f"{DIRECTUS_URL}/items/lojas/{loja_alvo['id']}", 
-                         headers=get_headers(),
+            directus.patch(f"{DIRECTUS_URL}/items/lojas/{loja_alvo['id']}", 
                          json={'senha_admin': hash_senha}, timeout=7)
-            cache.clear()
+            invalidar_loja(loja_alvo['id'], 'lojas')
             success = "Sua senha foi atualizada com sucesso! Você já pode fazer login."
         else:
             error = "A senha não pode ficar em branco."
@@ -1472,7 +2974,7 @@ def captura_lead(loja_slug):
     }
 
     try:
-        r = requests.post(f"{DIRECTUS_URL}/items/clientes_loja", headers=get_headers(), json=payload, timeout=7)
+        r = directus.post(f"{DIRECTUS_URL}/items/clientes_loja", json=payload, timeout=7)
         if r.status_code in [200, 201]:
             return jsonify({"sucesso": True, "mensagem": "Cadastrado com sucesso!"})
         return jsonify({"erro": "Erro ao salvar no banco de dados."}), 500
@@ -1501,10 +3003,8 @@ def feedback_tarefa(loja_slug, produto_id):
     mensagem = dados.get('mensagem', '')
     data_atual = datetime.now().strftime("%d/%m %H:%M")
 
-    headers = get_headers()
-    
     try:
-        r_prod = requests.get(f"{DIRECTUS_URL}/items/produtos/{produto_id}?fields=variantes,loja_id", headers=headers, timeout=7)
+        r_prod = directus.get(f"{DIRECTUS_URL}/items/produtos/{produto_id}?fields=variantes,loja_id", timeout=7)
         if r_prod.status_code != 200:
             return jsonify({"sucesso": False, "mensagem": "Produto não encontrado"}), 404
             
@@ -1526,7 +3026,8 @@ def feedback_tarefa(loja_slug, produto_id):
             "tipo_preco": "adicional"
         })
         
-        requests.patch(f"{DIRECTUS_URL}/items/produtos/{produto_id}", headers=headers, json={"variantes": variantes}, timeout=7)
+        directus.patch(f"{DIRECTUS_URL}/items/produtos/{produto_id}", json={"variantes": variantes}, timeout=7)
+        invalidar_loja(g.loja_id, 'produtos')
         
         return jsonify({"sucesso": True})
     except Exception as e:
@@ -1534,6 +3035,127 @@ def feedback_tarefa(loja_slug, produto_id):
         return jsonify({"sucesso": False, "mensagem": str(e)}), 500
 
 
+# AUTENTICAÇÃO DOS ENDPOINTS DE STATUS
+# Os status expõem erros internos e contadores: só com o header X-Status-Token igual ao STATUS_TOKEN.
+# Sem STATUS_TOKEN configurado os endpoints ficam fechados.
+STATUS_TOKEN = os.getenv("STATUS_TOKEN", "")
+
+def status_autorizado():
+    return bool(STATUS_TOKEN) and hmac.compare_digest(request.headers.get('X-Status-Token', ''), STATUS_TOKEN)
+
+
+# STATUS DO REGISTRO DE LOJAS (tamanho e atraso da sincronização no worker atual)
+@app.route('/api/status/registro-lojas')
+def status_registro_lojas():
+    if not status_autorizado(): return jsonify({"erro": "Não autorizado"}), 401
+    return jsonify(registro_lojas.status())
+
+
+# STATUS DO CLIENTE DIRECTUS (contadores por coleção e verbo no worker atual)
+@app.route('/api/status/directus')
+def status_directus():
+    if not status_autorizado(): return jsonify({"erro": "Não autorizado"}), 401
+    return jsonify(directus.status())
+
+
+# STATUS DO CACHE COMPARTILHADO
+@app.route('/api/status/cache')
+def status_cache():
+    if not status_autorizado(): return jsonify({"erro": "Não autorizado"}), 401
+    backend = cache.cache
+    if hasattr(backend, 'status'):
+        return jsonify(backend.status())
+    return jsonify({"tipo": type(backend).__name__})
+
+
+# WEBHOOK DO DIRECTUS PARA INVALIDAÇÃO DE CACHE
+# Recebe eventos de Flows/Webhooks do Directus (collection, keys, action) e invalida só as lojas afetadas.
+# Eventos sem loja identificável são registrados e ignorados; em exclusões o Flow deve mandar loja_id.
+# Autenticação: header X-Webhook-Signature: sha256=<hmac do corpo com o segredo>
+# ou, para Flows que só enviam headers fixos, X-Webhook-Token: <segredo>.
+DIRECTUS_WEBHOOK_SECRET = os.getenv("DIRECTUS_WEBHOOK_SECRET", "")
+
+def _webhook_autorizado():
+    if not DIRECTUS_WEBHOOK_SECRET:
+        return False
+    assinatura = request.headers.get('X-Webhook-Signature', '')
+    if assinatura:
+        esperado = hmac.new(DIRECTUS_WEBHOOK_SECRET.encode(), request.get_data(), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(assinatura.replace('sha256=', ''), esperado)
+    return hmac.compare_digest(request.headers.get('X-Webhook-Token', ''), DIRECTUS_WEBHOOK_SECRET)
+
+# Loja de cada item já visto pelo webhook, para atribuir exclusões (o item não existe mais no Directus)
+LOJA_DO_ITEM_TTL = int(os.getenv("LOJA_DO_ITEM_TTL", 90 * 86400))
+
+def _chave_loja_do_item(colecao, chave):
+    return f"loja_do_item_{colecao}_{chave}"
+
+def lembrar_loja_dos_itens(colecao, lojas_por_chave):
+    if lojas_por_chave:
+        cache.set_many({_chave_loja_do_item(colecao, k): l for k, l in lojas_por_chave.items()}, timeout=LOJA_DO_ITEM_TTL)
+
+def _id_loja(valor):
+    return valor.get('id') if isinstance(valor, dict) else valor
+
+def _lojas_dos_itens(colecao, chaves, dados, acao):
+    # Descobre a loja dos itens pelo corpo do evento (loja_id no topo ou no payload),
+    # pela loja lembrada de eventos anteriores ou, se o item ainda existe, consultando o Directus
+    payload = dados.get('payload')
+    loja = dados.get('loja_id') or (payload.get('loja_id') if isinstance(payload, dict) else None)
+    if loja:
+        loja = _id_loja(loja)
+        lembrar_loja_dos_itens(colecao, {k: loja for k in chaves})
+        return {loja}
+    if not chaves:
+        return set()
+
+    lembradas = cache.get_many(*[_chave_loja_do_item(colecao, k) for k in chaves])
+    lojas = {l for l in lembradas if l}
+    faltando = [k for k, l in zip(chaves, lembradas) if not l]
+    if not faltando or acao == 'delete':
+        return lojas
+    try:
+        ids = ",".join(str(k) for k in faltando)
+        r = directus.get(f"{DIRECTUS_URL}/items/{colecao}?filter[id][_in]={ids}&fields=id,loja_id&limit=-1", timeout=7)
+        if r.status_code == 200:
+            encontradas = {i['id']: _id_loja(i['loja_id']) for i in r.json()['data'] if i.get('loja_id')}
+            lembrar_loja_dos_itens(colecao, encontradas)
+            lojas.update(encontradas.values())
+    except Exception as e:
+        print(f"Webhook: erro ao buscar loja dos itens de {colecao}: {e}")
+    return lojas
+
+@app.route('/api/cache/invalidate', methods=['POST'])
+def webhook_invalidar_cache():
+    if not _webhook_autorizado():
+        return jsonify({"sucesso": False, "mensagem": "Assinatura inválida"}), 403
+
+    dados = request.get_json(silent=True) or {}
+    colecao = dados.get('collection', '')
+    acao = dados.get('action') or dados.get('event', '').split('.')[-1]
+    chaves = dados.get('keys') or ([dados['key']] if dados.get('key') is not None else [])
+
+    if colecao == 'lojas':
+        for loja_id in chaves:
+            invalidar_loja(loja_id, 'lojas')
+        return jsonify({"sucesso": True, "colecao": colecao, "acao": acao, "lojas": chaves})
+
+    if colecao not in COLECOES_LOJA:
+        # Coleções que não alimentam nenhum cache (ex clientes_loja)
+        return jsonify({"sucesso": True, "colecao": colecao, "ignorado": True})
+
+    lojas = _lojas_dos_itens(colecao, chaves, dados, acao)
+    if not lojas:
+        # Sem loja identificável não invalida nada: invalidar todas as lojas derruba o cache do SaaS inteiro
+        # Para exclusões de itens nunca vistos, o Flow deve enviar loja_id no corpo
+        print(f"Webhook: evento {acao} em {colecao} {chaves} sem loja identificável, ignorado")
+        return jsonify({"sucesso": True, "colecao": colecao, "acao": acao, "ignorado": True})
+
+    for loja_id in lojas:
+        invalidar_loja(loja_id, colecao)
+    return jsonify({"sucesso": True, "colecao": colecao, "acao": acao, "lojas": sorted(lojas, key=str)})
+
+
 # API FRETE
 @app.route('/api/calcular-frete', methods=['POST'])
 def api_frete():
@@ -1547,5 +3169,9 @@ def logout():
     return redirect('/')
 
 # INICIALIZAÇÃO
+# Aquece os templates na importação: cada worker do gunicorn carrega o app antes de atender
+if TEMPLATES_AQUECER:
+    precompilar_templates()
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,183 @@
+# BACKEND DE CACHE COMPARTILHADO ENTRE WORKERS
+# Arquivo SQLite local (modo WAL) usado pelo Flask-Caching no lugar do SimpleCache.
+# Todos os workers do gunicorn enxergam as mesmas entradas, então cada loja é buscada
+# uma vez por máquina e cache.clear() / delete valem para todos os processos.
+# Não depende de nenhum serviço externo.
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from flask_caching.backends.base import BaseCache
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, path, default_timeout=300, max_bytes=256 * 1024 * 1024, ignore_delete_many_errors=False):
+        super().__init__(default_timeout=default_timeout, ignore_delete_many_errors=ignore_delete_many_errors)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._bytes_desde_limpeza = 0
+        self._lock_limpeza = threading.Lock()
+        self._conexao().execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " chave TEXT PRIMARY KEY, valor BLOB NOT NULL, expira REAL NOT NULL,"
+            " tamanho INTEGER NOT NULL, gravado REAL NOT NULL)"
+        )
+        self._conexao().execute("CREATE INDEX IF NOT EXISTS cache_gravado ON cache (gravado)")
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(
+            path=config.get("CACHE_SQLITE_PATH", "/tmp/leanttro_cache.sqlite3"),
+            max_bytes=config.get("CACHE_SQLITE_MAX_BYTES", 256 * 1024 * 1024),
+        )
+        return cls(*args, **kwargs)
+
+    def _conexao(self):
+        # Uma conexão por thread e por processo (conexões não sobrevivem ao fork)
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def _expira(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return 0 if timeout == 0 else time.time() + timeout
+
+    @staticmethod
+    def _vivo(expira):
+        return expira == 0 or expira > time.time()
+
+    def get(self, key):
+        row = self._conexao().execute("SELECT valor, expira FROM cache WHERE chave = ?", (key,)).fetchone()
+        if row is None or not self._vivo(row[1]):
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            return None
+
+    def has(self, key):
+        row = self._conexao().execute("SELECT expira FROM cache WHERE chave = ?", (key,)).fetchone()
+        return row is not None and self._vivo(row[0])
+
+    def set(self, key, value, timeout=None):
+        dump = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._conexao().execute(
+            "INSERT OR REPLACE INTO cache (chave, valor, expira, tamanho, gravado) VALUES (?, ?, ?, ?, ?)",
+            (key, dump, self._expira(timeout), len(dump), time.time()),
+        )
+        self._registrar_escrita(len(dump))
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        # Uma transação para o lote inteiro (aquecimento de caches por loja)
+        agora, expira = time.time(), self._expira(timeout)
+        linhas = []
+        for key, value in mapping.items():
+            dump = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            linhas.append((key, dump, expira, len(dump), agora))
+        con = self._conexao()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.executemany(
+                "INSERT OR REPLACE INTO cache (chave, valor, expira, tamanho, gravado) VALUES (?, ?, ?, ?, ?)", linhas
+            )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        self._registrar_escrita(sum(l[3] for l in linhas))
+        return list(mapping.keys())
+
+    def add(self, key, value, timeout=None):
+        # Atômico entre processos: só grava se a chave não existe ou já expirou
+        dump = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        agora = time.time()
+        cur = self._conexao().execute(
+            "INSERT INTO cache (chave, valor, expira, tamanho, gravado) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(chave) DO UPDATE SET valor = excluded.valor, expira = excluded.expira,"
+            " tamanho = excluded.tamanho, gravado = excluded.gravado"
+            " WHERE cache.expira != 0 AND cache.expira <= ?",
+            (key, dump, self._expira(timeout), len(dump), agora, agora),
+        )
+        if cur.rowcount > 0:
+            self._registrar_escrita(len(dump))
+            return True
+        return False
+
+    def get_or_set(self, key, construir, timeout=None):
+        # Primeiro a gravar vence; quem perder a corrida devolve o valor já gravado
+        valor = self.get(key)
+        if valor is not None:
+            return valor
+        valor = construir()
+        if self.add(key, valor, timeout):
+            return valor
+        existente = self.get(key)
+        return existente if existente is not None else valor
+
+    def inc(self, key, delta=1):
+        con = self._conexao()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT valor, expira FROM cache WHERE chave = ?", (key,)).fetchone()
+            atual = pickle.loads(row[0]) if row and self._vivo(row[1]) else 0
+            novo = int(atual) + delta
+            dump = pickle.dumps(novo, pickle.HIGHEST_PROTOCOL)
+            expira = row[1] if row and self._vivo(row[1]) else self._expira(None)
+            con.execute(
+                "INSERT OR REPLACE INTO cache (chave, valor, expira, tamanho, gravado) VALUES (?, ?, ?, ?, ?)",
+                (key, dump, expira, len(dump), time.time()),
+            )
+            con.execute("COMMIT")
+            return novo
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def delete(self, key):
+        return self._conexao().execute("DELETE FROM cache WHERE chave = ?", (key,)).rowcount > 0
+
+    def clear(self):
+        self._conexao().execute("DELETE FROM cache")
+        return True
+
+    def _registrar_escrita(self, tamanho):
+        # A limpeza por tamanho roda a cada ~1% do limite gravado, não a cada set
+        self._bytes_desde_limpeza += tamanho
+        if self._bytes_desde_limpeza >= max(self.max_bytes // 100, 1):
+            self._limpar()
+
+    def _limpar(self):
+        if not self._lock_limpeza.acquire(blocking=False):
+            return
+        try:
+            self._bytes_desde_limpeza = 0
+            con = self._conexao()
+            con.execute("DELETE FROM cache WHERE expira != 0 AND expira <= ?", (time.time(),))
+            total = con.execute("SELECT COALESCE(SUM(tamanho), 0) FROM cache").fetchone()[0]
+            # Remove as entradas gravadas há mais tempo até ficar abaixo de 90% do limite
+            # Entradas permanentes (versões) são as últimas a sair
+            while total > self.max_bytes * 0.9:
+                lote = con.execute("SELECT chave, tamanho FROM cache ORDER BY expira = 0, gravado LIMIT 20").fetchall()
+                if not lote:
+                    break
+                con.executemany("DELETE FROM cache WHERE chave = ?", [(c,) for c, _ in lote])
+                total -= sum(t for _, t in lote)
+        finally:
+            self._lock_limpeza.release()
+
+    def status(self):
+        con = self._conexao()
+        entradas, total = con.execute("SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM cache").fetchone()
+        return {"entradas": entradas, "bytes": total, "max_bytes": self.max_bytes, "path": self.path}
@@ -0,0 +1,65 @@
+import os
+import re
+import sys
+
+# Cache em memória: o teste não depende do arquivo SQLite compartilhado
+os.environ.setdefault("CACHE_TYPE", "SimpleCache")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import app as loja_app
+
+LOJA = {"id": 2, "slug": "doces", "nome": "Doces", "template_ativo": "index", "dominio_proprio": None,
+        "date_created": "2025-01-01T00:00:00", "date_updated": None}
+CATEGORIAS = [{"id": 10, "nome": "Bolos", "slug": "bolos", "sort": 1},
+              {"id": 20, "nome": "Tortas", "slug": "tortas", "sort": 2}]
+# 30 produtos em cada categoria, intercalados na ordem da vitrine
+PRODUTOS = [{"id": i, "nome": f"Produto {i}", "slug": f"produto-{i}", "sort": i, "preco": "10",
+             "status": "published", "loja_id": 2, "categoria_id": 10 if i % 2 else 20}
+            for i in range(1, 61)]
+
+
+# Tema -> trecho que só o card daquele tema tem
+CARDS_TEMA = {"index": "hover:shadow-2xl", "direto": "rounded-[2.5rem]", "direto_index": "md:min-w-[230px]"}
+
+
+@pytest.fixture(params=sorted(CARDS_TEMA))
+def tema(request):
+    return request.param
+
+
+@pytest.fixture
+def cliente(monkeypatch, tema):
+    registro = loja_app.RegistroLojas()
+    registro._pid = os.getpid()
+    registro.carregado = True
+    registro._indexar({**LOJA, "template_ativo": tema})
+    monkeypatch.setattr(loja_app, "registro_lojas", registro)
+    monkeypatch.setattr(loja_app, "buscar_dados_vitrine", lambda loja_id: loja_app.DadosVitrine(
+        categorias=[dict(c) for c in CATEGORIAS], produtos=[dict(p) for p in PRODUTOS]))
+    loja_app.cache.clear()
+    return loja_app.app.test_client()
+
+
+def test_scroll_infinito_mantem_a_categoria_filtrada(cliente, tema):
+    html = cliente.get("/doces/?categoria=10").get_data(as_text=True)
+    # Primeira página renderizada no servidor, o resto fica para o scroll
+    assert len(set(re.findall(r'/doces/produto/(produto-\d+)"', html))) == loja_app.PRODUTOS_POR_PAGINA
+    sentinela = re.search(r'id="produtos-sentinela" data-cursor="([^"]+)" data-categoria="([^"]*)"', html)
+    assert sentinela, "primeira página filtrada deveria ter próxima página"
+    cursor, categoria = sentinela.groups()
+    assert categoria == "10"
+
+    vistos = []
+    while cursor:
+        resposta = cliente.get(f"/doces/api/produtos?formato=html&cursor={cursor}&categoria={categoria}").get_json()
+        assert all(p["categoria_id"] == 10 for p in resposta["produtos"])
+        # Páginas seguintes saem com o mesmo card da primeira
+        assert CARDS_TEMA[tema] in resposta["html"]
+        vistos += [p["id"] for p in resposta["produtos"]]
+        cursor = resposta["proximo_cursor"]
+
+    primeira_pagina = loja_app.PRODUTOS_POR_PAGINA
+    esperados = [p["id"] for p in PRODUTOS if p["categoria_id"] == 10][primeira_pagina:]
+    assert vistos == esperados